@@ -0,0 +1,201 @@
+"""
+Offline benchmark of /stats request stages on a synthetic or real database:
+
+    python bench.py --db_path ./bench.db --machines 1000 --days 90 --out before.json
+    python bench.py --db_path ./bench.db --out after.json --compare before.json
+
+Database is generated by src/synthetic.py when db_path does not exist.
+Every sample requests all tables of one machine over the last N days of
+data and times the stages separately:
+
+    pandas engine: sql (execute + fetch), dataframe, json, gzip
+    sql engine:    sql_json (json assembled by SQLite), gzip
+
+Results are p50/p95/p99 in ms for each engine, range and stage.
+"""
+from __future__ import annotations
+
+import os
+import json
+import argparse
+import logging
+import platform
+import sqlite3
+import subprocess
+from time import time, perf_counter
+
+import numpy as np
+import pandas as pd
+
+from src import const
+from src import schema
+from src.synthetic import create_db
+from src.vastdb import VastDB, _get_sql_query, df_to_json
+from main import compress_data
+
+DAY = 24 * 3600
+PERCENTILES = [50, 95, 99]
+
+
+def parse_ranges(ranges: str) -> list:
+    """ '1,7,30,all' -> [1, 7, 30, None] """
+    return [None if r == 'all' else int(r) for r in ranges.split(',')]
+
+
+def range_name(days: int | None) -> str:
+    return 'all' if days is None else f'{days}d'
+
+
+def time_pandas(vastdb: VastDB, machine_id: int, from_ts, fmt: str) -> dict:
+    """ Stage timings of get_machine_stats_pandas() path, seconds """
+    times = {}
+    tables = const.TS_TABLES + const.SNP_TABLES
+
+    start = perf_counter()
+    rows = {}
+    for tbl_name in tables:
+        tbl_from = from_ts if tbl_name in const.TS_TABLES else None
+        cursor = vastdb.conn.execute(_get_sql_query(machine_id, tbl_name, tbl_from))
+        rows[tbl_name] = (cursor.fetchall(), [col[0] for col in cursor.description])
+    times['sql'] = perf_counter() - start
+
+    start = perf_counter()
+    frames = {tbl_name: pd.DataFrame.from_records(data, columns=columns) for tbl_name, (data, columns) in rows.items()}
+    times['dataframe'] = perf_counter() - start
+
+    start = perf_counter()
+    result = {tbl_name: df_to_json(df, fmt) for tbl_name, df in frames.items()}
+    json_data = ('{' + ','.join([f'"{k}": {v}' for (k, v) in result.items()]) + '}').encode('utf-8')
+    times['json'] = perf_counter() - start
+
+    start = perf_counter()
+    compress_data(json_data)
+    times['gzip'] = perf_counter() - start
+    return times
+
+
+def time_sql(vastdb: VastDB, machine_id: int, from_ts, fmt: str) -> dict:
+    """ Stage timings of get_machine_stats_sql() path, seconds """
+    times = {}
+    start = perf_counter()
+    json_data = vastdb.get_machine_stats_sql(machine_id, from_ts, None, fmt, resolution='raw')
+    times['sql_json'] = perf_counter() - start
+
+    start = perf_counter()
+    compress_data(json_data)
+    times['gzip'] = perf_counter() - start
+    return times
+
+
+ENGINES = {'pandas': time_pandas, 'sql': time_sql}
+
+
+def summarize(samples: list) -> dict:
+    """ [{stage: seconds}] -> {stage: {p50, p95, p99, mean}} in ms, plus total """
+    stages = list(samples[0]) + ['total']
+    result = {}
+    for stage in stages:
+        if stage == 'total':
+            vals = np.array([sum(s.values()) for s in samples]) * 1000
+        else:
+            vals = np.array([s[stage] for s in samples]) * 1000
+        result[stage] = {f'p{p}': round(float(v), 3) for p, v in zip(PERCENTILES, np.percentile(vals, PERCENTILES))}
+        result[stage]['mean'] = round(float(vals.mean()), 3)
+    return result
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(db_path: str, ranges: list, n_samples: int, repeat: int, fmt: str, seed: int) -> dict:
+    vastdb = VastDB(db_path)
+    conn = vastdb.conn
+    end_ts = conn.execute("SELECT max(timestamp) FROM reliability_ts").fetchone()[0]
+    machine_ids = [row[0] for row in conn.execute("SELECT machine_id FROM machine_host_map ORDER BY machine_id")]
+    machine_ids = np.random.default_rng(seed).choice(machine_ids, min(n_samples, len(machine_ids)), replace=False)
+
+    results = {}
+    for engine, func in ENGINES.items():
+        results[engine] = {}
+        for days in ranges:
+            from_ts = end_ts - days * DAY if days else None
+            func(vastdb, int(machine_ids[0]), from_ts, fmt)    # warm up page cache
+            samples = [func(vastdb, int(machine_id), from_ts, fmt)
+                       for _ in range(repeat) for machine_id in machine_ids]
+            results[engine][range_name(days)] = summarize(samples)
+
+    vastdb.close()
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'date': pd.Timestamp.now(tz='UTC').isoformat(timespec='seconds'),
+            'db_path': db_path,
+            'db_size': os.path.getsize(db_path),
+            'machines': len(machine_ids),
+            'repeat': repeat,
+            'format': fmt,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'results': results,
+    }
+
+
+def print_results(report: dict, base: dict = None, stat: str = 'p50'):
+    """ Table of `stat` for every stage, with ratio to base report if given """
+    for engine, ranges in report['results'].items():
+        print(f"\n[{engine}] {stat}, ms" + (f" (vs {base['meta'].get('commit')})" if base else ''))
+        for rng, stages in ranges.items():
+            cells = []
+            for stage, stats in stages.items():
+                cell = f"{stage} {stats[stat]:8.2f}"
+                old = (base or {}).get('results', {}).get(engine, {}).get(rng, {}).get(stage)
+                if old and old[stat]:
+                    cell += f" {stats[stat] / old[stat]:5.2f}x"
+                cells.append(cell)
+            print(f"  {rng:>5}: " + ' | '.join(cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Vast Stats /stats benchmark')
+    parser.add_argument('--db_path', type=str, default='./bench.db', help='database, generated if missing')
+    parser.add_argument('--machines', type=int, default=1000, help='fleet size of generated database')
+    parser.add_argument('--days', type=int, default=90, help='history length of generated database')
+    parser.add_argument('--ranges', type=str, default='1,7,30,all', help='requested ranges in days')
+    parser.add_argument('--samples', type=int, default=50, help='number of machines to request')
+    parser.add_argument('--repeat', type=int, default=3, help='requests per machine')
+    parser.add_argument('--format', type=str, default=const.FORMATS[0], choices=const.FORMATS)
+    parser.add_argument('--seed', type=int, default=0, help='seed of generated database and samples')
+    parser.add_argument('--no_indexes', action='store_true', help='do not create (machine_id, timestamp) indexes')
+    parser.add_argument('--out', type=str, default=None, help='write results json to file')
+    parser.add_argument('--compare', type=str, default=None, help='results json to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not os.path.exists(args.db_path):
+        create_db(args.db_path, args.machines, args.days, args.seed)
+    if not args.no_indexes:
+        schema.ensure_indexes(args.db_path, const.TS_TABLES + const.SNP_TABLES, const.FIELD_PROFILES[const.DEFAULT_FIELDS])
+
+    start = time()
+    report = run(args.db_path, parse_ranges(args.ranges), args.samples, args.repeat, args.format, args.seed)
+    logging.info(f"Benchmark finished in {time() - start:.1f}s")
+
+    base = None
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+    print_results(report, base)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Results written to {args.out}")
@@ -0,0 +1,245 @@
+"""
+Load test of the whole serving path at rising concurrency:
+
+    python loadtest.py --db_path ./bench.db --levels 1,4,16,64 --duration 20 --out load.json
+    python loadtest.py --server_args="--workers 4" --compare load.json
+    python loadtest.py --url http://127.0.0.1:3000 --db_path ./vast.db
+
+Without --url a server is started on the database (generated by
+src/synthetic.py when missing) and stopped afterwards. Every level runs
+`concurrency` clients in closed loop, each sending the next request as
+soon as the previous one is answered, with the request mix of dashboard
+users (REQUEST_MIX):
+
+    recent:  2 weeks of one machine, as requested by the dashboard
+    history: full history of one machine
+    static:  index.html and script.js
+
+Results per level are requests/sec, latency p50/p95/p99 in ms and error
+count, overall and for each kind of request.
+
+Machines are picked at random from the whole fleet with a different seed
+for every level. The locally started server runs with --cache_size 0
+unless --server_args set it, so the test measures computing responses
+rather than hits of the response cache.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import random
+import argparse
+import logging
+import sqlite3
+import subprocess
+import threading
+import http.client
+from time import time, perf_counter, sleep
+from urllib.parse import urlparse
+from datetime import datetime, timezone
+
+import numpy as np
+
+from src import const
+from src.synthetic import create_db
+from bench import git_commit
+
+DAY = 24 * 3600
+PERCENTILES = [50, 95, 99]
+# kind: share of requests
+REQUEST_MIX = {'recent': 0.6, 'history': 0.15, 'static': 0.25}
+RECENT_DAYS = 14
+# dashboard asks for about as many points as the plot has pixels
+POINTS = 960
+STATIC_URLS = ['/', '/script.js']
+HEADERS = {'Accept-Encoding': 'gzip'}
+
+
+def to_date(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d')
+
+
+class RequestMix:
+    """ Random urls with the shares of REQUEST_MIX """
+    def __init__(self, machine_ids: list, end_ts: int, seed: int = 0):
+        self.machine_ids = machine_ids
+        self.recent_from = to_date(end_ts - RECENT_DAYS * DAY)
+        self.kinds = list(REQUEST_MIX)
+        self.weights = list(REQUEST_MIX.values())
+        self.rng = random.Random(seed)
+
+    def next(self) -> tuple:
+        """ :return: kind, url, headers """
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        if kind == 'static':
+            return kind, self.rng.choice(STATIC_URLS), HEADERS
+        url = f"/stats?format=columns&align=1&points={POINTS}&machine_id={self.rng.choice(self.machine_ids)}"
+        if kind == 'recent':
+            url += f"&from={self.recent_from}"
+        return kind, url, {**HEADERS, 'Accept': f'{const.BINARY_MIME}, application/json'}
+
+
+def client(host: str, port: int, mix: RequestMix, stop: threading.Event, samples: list):
+    """ Closed-loop client, appends (kind, latency seconds, ok) to samples """
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    while not stop.is_set():
+        kind, url, headers = mix.next()
+        start = perf_counter()
+        try:
+            conn.request('GET', url, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+            if response.will_close:
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+        samples.append((kind, perf_counter() - start, ok))
+    conn.close()
+
+
+def summarize(samples: list, duration: float) -> dict:
+    """ [(kind, seconds, ok)] -> {rps, p50, p95, p99, errors, requests} with latencies of successful requests in ms """
+    latencies = np.array([s[1] for s in samples if s[2]]) * 1000
+    result = {'requests': len(samples), 'rps': round(len(samples) / duration, 1),
+              'errors': sum(1 for s in samples if not s[2])}
+    if latencies.size:
+        result.update({f'p{p}': round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))})
+    return result
+
+
+def run_level(url: str, concurrency: int, duration: float, mix_args: tuple, seed: int = 0) -> dict:
+    parsed = urlparse(url)
+    stop = threading.Event()
+    samples = []
+    # clients of every level get their own seeds, so levels don't repeat each other's requests
+    threads = [threading.Thread(target=client, daemon=True, args=(parsed.hostname, parsed.port,
+                                                                  RequestMix(*mix_args, seed=seed + i), stop, samples))
+               for i in range(concurrency)]
+    start = time()
+    for thread in threads:
+        thread.start()
+    sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - start
+
+    result = {'all': summarize(samples, elapsed)}
+    for kind in REQUEST_MIX:
+        result[kind] = summarize([s for s in samples if s[0] == kind], elapsed)
+    return result
+
+
+def wait_ready(url: str, timeout: float = 60):
+    parsed = urlparse(url)
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=5)
+            conn.request('GET', '/metrics')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            sleep(0.2)
+    raise TimeoutError(f"server at {url} did not start in {timeout}s")
+
+
+def start_server(db_path: str, port: int, server_args: list) -> subprocess.Popen:
+    """ Server on db_path, which must be absolute as the server runs in the repository directory """
+    cmd = [sys.executable, 'main.py', '--db_path', db_path, '--port', str(port),
+           '--log_path', os.devnull] + server_args
+    if not any(arg.startswith('--cache_size') for arg in server_args):
+        cmd += ['--cache_size', '0']
+    logging.info(f"Starting server: {' '.join(cmd)}")
+    return subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def print_results(report: dict, base: dict = None):
+    """ Table of every level, with ratio of rps and p95 to base report if given """
+    print(f"\n{'level':>6} {'kind':>8} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>7}"
+          + (f"  (vs {base['meta'].get('commit')})" if base else ''))
+    for level, kinds in report['results'].items():
+        for kind, stats in kinds.items():
+            cells = f"{level:>6} {kind:>8} {stats['rps']:8.1f}"
+            cells += ''.join([f" {stats.get(f'p{p}', float('nan')):8.2f}" for p in PERCENTILES])
+            cells += f" {stats['errors']:7d}"
+            old = (base or {}).get('results', {}).get(level, {}).get(kind)
+            if old and old.get('rps') and old.get('p95') and 'p95' in stats:
+                cells += f"  rps {stats['rps'] / old['rps']:5.2f}x p95 {stats['p95'] / old['p95']:5.2f}x"
+            print(cells)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Vast Stats load test')
+    parser.add_argument('--url', type=str, default=None, help='running server, started locally if not set')
+    parser.add_argument('--db_path', type=str, default='./bench.db', help='database, generated if missing')
+    parser.add_argument('--machines', type=int, default=1000, help='fleet size of generated database')
+    parser.add_argument('--days', type=int, default=90, help='history length of generated database')
+    parser.add_argument('--port', type=int, default=3100, help='port of locally started server')
+    parser.add_argument('--server_args', type=str, default='', help='extra arguments of locally started server')
+    parser.add_argument('--levels', type=str, default='1,2,4,8,16,32', help='concurrency levels')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per level')
+    parser.add_argument('--seed', type=int, default=0, help='seed of generated database and request mix')
+    parser.add_argument('--out', type=str, default=None, help='write results json to file')
+    parser.add_argument('--compare', type=str, default=None, help='results json to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # server is started in the repository directory, relative path would point elsewhere
+    args.db_path = os.path.abspath(args.db_path)
+
+    if not os.path.exists(args.db_path):
+        create_db(args.db_path, args.machines, args.days, args.seed)
+    conn = sqlite3.connect(f"file:{args.db_path}?mode=ro", uri=True)
+    end_ts = conn.execute("SELECT max(timestamp) FROM reliability_ts").fetchone()[0]
+    machine_ids = [row[0] for row in conn.execute("SELECT DISTINCT machine_id FROM machine_host_map")]
+    conn.close()
+
+    server = None
+    url = args.url
+    if url is None:
+        url = f"http://127.0.0.1:{args.port}"
+        server = start_server(args.db_path, args.port, args.server_args.split())
+    try:
+        wait_ready(url)
+        results = {}
+        seed = args.seed
+        for level in [int(level) for level in args.levels.split(',')]:
+            results[str(level)] = run_level(url, level, args.duration, (machine_ids, end_ts), seed)
+            seed += level
+            stats = results[str(level)]['all']
+            logging.info(f"[{level:>3} clients] {stats['rps']} rps, p95 {stats.get('p95')}ms, {stats['errors']} errors")
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'url': args.url,
+            'db_path': args.db_path,
+            'server_args': args.server_args,
+            'duration': args.duration,
+            'cpus': os.cpu_count(),
+            'mix': REQUEST_MIX,
+        },
+        'results': results,
+    }
+
+    base = None
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+    print_results(report, base)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Results written to {args.out}")
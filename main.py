@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 import sys
+import json
+import shutil
+import tempfile
 
-import pandas as pd
-from time import time
+from time import time, perf_counter
 
 import http.server
-import socketserver
 import threading
 import signal
 import sqlite3
@@ -14,18 +15,33 @@ import argparse
 import logging
 from logging.handlers import RotatingFileHandler
 
-import gzip
+import zlib
 from urllib.parse import urlparse, parse_qs
 from http import HTTPStatus
 
-from src.utils import time_ms, datetime_to_ts, get_error_info
+from src.utils import LazyModule, time_ms, datetime_to_ts, get_error_info, ts_utc_now, debug_enabled
 from src import const
+from src import metrics
 from src.vastdb import VastDB
+from src.server import ThreadPoolHTTPServer
+from src.cache import LRUCache
+from src.fleet import get_fleet_stats
+from src.rollup import Rollup
+from src.snapshots import SnapshotStore
+from src.archive import Archive
+from src.prefork import Supervisor
+from src.admission import Admission, SingleFlight, Overloaded
+from src.static import StaticAssets, make_etag, etag_matches
+
+# only /test, fleet stats and dataframe based formats import it
+pd = LazyModule('pandas')
+
+# part of every /stats etag, so responses of previous server run are not reused
+ETAG_SEED = ts_utc_now()
 
 
 def parse_params(params: dict) -> tuple:
     machine_id = params.get('machine_id', [None])[0]
-    from_date, to_date = params.get('from', [None])[0], params.get('to', [None])[0]
 
     if machine_id is None:
         raise ValueError('machine_id is required')
@@ -35,6 +51,13 @@ def parse_params(params: dict) -> tuple:
     except ValueError:
         raise ValueError(f'machine_id should be an integer: {machine_id}')
 
+    from_timestamp, to_timestamp = parse_dates(params)
+    return machine_id, from_timestamp, to_timestamp
+
+
+def parse_dates(params: dict) -> tuple:
+    from_date, to_date = params.get('from', [None])[0], params.get('to', [None])[0]
+
     from_timestamp = None
     if from_date:
         from_timestamp = datetime_to_ts(from_date)
@@ -43,83 +66,257 @@ def parse_params(params: dict) -> tuple:
     if to_date:
         to_timestamp = datetime_to_ts(to_date)
 
-    return machine_id, from_timestamp, to_timestamp
+    return from_timestamp, to_timestamp
 
 
-def get_dbrequest_sql(params: dict, db_table: str) -> str:
-    # unpack parameters
-    machine_ids, from_ts, to_ts = parse_params(params)
+def parse_batch_params(params: dict) -> tuple:
+    """
+    :return: list of machine_ids or None, host_id or None, from and to timestamps
+    """
+    machine_ids = params.get('machine_id', [None])[0]
+    host_id = params.get('host_id', [None])[0]
 
-    sql_query = f"SELECT * FROM {db_table} WHERE"
+    if machine_ids is None and host_id is None:
+        raise ValueError('machine_id or host_id is required')
 
-    # add machine_id
-    sql_query += f" machine_id IN ({','.join(machine_ids)})"
+    if machine_ids is not None:
+        try:
+            machine_ids = sorted({int(machine_id) for machine_id in machine_ids.split(',') if machine_id})
+        except ValueError:
+            raise ValueError(f'machine_id should be comma separated integers: {machine_ids}')
+        if not machine_ids or len(machine_ids) > const.MAX_BATCH:
+            raise ValueError(f'machine_id should contain from 1 to {const.MAX_BATCH} ids')
 
-    # add 'from' and 'to' constraints
-    if from_ts:
-        sql_query += f" AND timestamp >= '{from_ts}'"
-    if to_ts:
-        sql_query += f" AND timestamp <= '{to_ts}'"
+    if host_id is not None:
+        try:
+            host_id = int(host_id)
+        except ValueError:
+            raise ValueError(f'host_id should be an integer: {host_id}')
 
-    return sql_query
+    from_timestamp, to_timestamp = parse_dates(params)
+    return machine_ids, host_id, from_timestamp, to_timestamp
 
 
-def get_last_value_sql(params: dict, db_table: str) -> str:
-    machine_ids, _, _ = parse_params(params)
-    return f"SELECT * FROM {db_table} WHERE machine_id={machine_ids[0]} ORDER BY timestamp DESC LIMIT 1"
+def parse_fleet_params(params: dict) -> tuple:
+    from_ts, to_ts = parse_dates(params)
+    to_ts = to_ts or ts_utc_now()
+    from_ts = from_ts or to_ts - const.FLEET_DEFAULT_DAYS * 24 * 3600
 
+    if from_ts >= to_ts:
+        raise ValueError("'from' should be earlier than 'to'")
+    if to_ts - from_ts > const.FLEET_MAX_DAYS * 24 * 3600:
+        raise ValueError(f'range should not exceed {const.FLEET_MAX_DAYS} days')
+    return from_ts, to_ts
 
-def compress_data(json_data):
-    start = time()
-    compressed = gzip.compress(json_data, compresslevel=1)
-    logging.debug(f"compress json:     {time_ms(time() - start)} ms")
-    logging.debug(f"compression ratio: {len(compressed) / len(json_data) * 100:.1f}%")
-    logging.debug(f"data size:         {len(compressed)} bytes")
+
+def parse_format(params: dict) -> str:
+    fmt = params.get('format', [const.FORMATS[0]])[0]
+    if fmt not in const.FORMATS:
+        raise ValueError(f'format should be one of {const.FORMATS}: {fmt}')
+    return fmt
+
+
+def accepts_binary(headers) -> bool:
+    return const.BINARY_MIME in headers.get('Accept', '')
+
+
+def parse_flag(params: dict, name: str) -> bool:
+    return params.get(name, ['0'])[0].lower() in ('1', 'true', 'yes')
+
+
+def parse_points(params: dict) -> int | None:
+    points = params.get('points', [None])[0]
+    if points is None:
+        return None
+
+    try:
+        points = int(points)
+    except ValueError:
+        raise ValueError(f'points should be an integer: {points}')
+
+    if points < const.MIN_POINTS:
+        raise ValueError(f'points should be at least {const.MIN_POINTS}: {points}')
+    return points
+
+
+def parse_since(params: dict) -> dict | None:
+    """
+    Latest timestamps client already has: `since` for every table,
+    `since_<tbl_name>` for a single one.
+    :return: {tbl_name: timestamp} or None when not a delta request
+    """
+    tables = const.TS_TABLES + const.SNP_TABLES
+    names = ['since'] + [f'since_{tbl_name}' for tbl_name in tables]
+    values = {}
+    for name in names:
+        value = params.get(name, [None])[0]
+        if value is None:
+            continue
+        try:
+            values[name] = int(value)
+        except ValueError:
+            raise ValueError(f'{name} should be an integer timestamp: {value}')
+
+    if not values:
+        return None
+    default = values.get('since', 0)
+    return {tbl_name: values.get(f'since_{tbl_name}', default) for tbl_name in tables}
+
+
+def parse_machines_params(params: dict) -> tuple:
+    """ /machines?prefix=<digits>&limit=N """
+    prefix = params.get('prefix', [''])[0]
+    if not prefix.isdigit():
+        raise ValueError(f"prefix must be digits, got '{prefix}'")
+    limit = int(params.get('limit', [const.MACHINES_LIMIT])[0])
+    if not 1 <= limit <= const.MACHINES_MAX_LIMIT:
+        raise ValueError(f"limit must be in 1..{const.MACHINES_MAX_LIMIT}")
+    return prefix, limit
+
+
+def parse_fields(params: dict, registry) -> dict | None:
+    """ fields=<profile or table.column list>, see schema.Registry.resolve() """
+    return registry.resolve(params.get('fields', [const.DEFAULT_FIELDS])[0])
+
+
+def fields_key(fields: dict | None) -> tuple | None:
+    """ Hashable form of parsed fields for cache keys """
+    return fields and tuple((tbl_name, tuple(columns)) for tbl_name, columns in fields.items())
+
+
+def parse_resolution(params: dict) -> str:
+    resolution = params.get('resolution', [const.RESOLUTIONS[0]])[0]
+    if resolution not in const.RESOLUTIONS:
+        raise ValueError(f'resolution should be one of {const.RESOLUTIONS}: {resolution}')
+    return resolution
+
+
+def compress_data(data: bytes | list):
+    """ Gzip bytes or list of bytes-like parts """
+    start = perf_counter()
+    parts = [data] if isinstance(data, bytes) else data
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)    # gzip container
+    compressed = b''.join([compressor.compress(part) for part in parts] + [compressor.flush()])
+    elapsed = perf_counter() - start
+    metrics.COMPRESS_SECONDS.observe(elapsed)
+    if debug_enabled():
+        size = sum(memoryview(part).nbytes for part in parts)
+        logging.debug(f"compress data:     {time_ms(elapsed)} ms")
+        logging.debug(f"compression ratio: {len(compressed) / size * 100:.1f}%")
+        logging.debug(f"data size:         {len(compressed)} bytes")
     return compressed
 
 
 class RequestHandler(http.server.SimpleHTTPRequestHandler):
+    # endpoint label of metrics, static files are counted together
+    ENDPOINTS = ['/stats', '/stats/batch', '/fleet', '/machines', '/metrics', '/test']
+
     def __init__(self, *args, **kwargs) -> None:
+        self.endpoint = 'static'
         super().__init__(*args, directory=const.STATIC_PATH, **kwargs)
 
     def do_GET(self):
-        logging.debug(f"Received request: {self.request}")
+        parsed_url = urlparse(self.path)
+        self.endpoint = parsed_url.path if parsed_url.path in self.ENDPOINTS else 'static'
+
+        start = perf_counter()
+        with metrics.IN_FLIGHT.track(endpoint=self.endpoint):
+            self.route(parsed_url)
+        metrics.REQUEST_SECONDS.observe(perf_counter() - start, endpoint=self.endpoint)
+
+    def route(self, parsed_url):
+        if debug_enabled():
+            logging.debug(f"Received request: {self.request}")
         if self.request.getpeername()[0] not in const.IP_LIST:
             self.send_error(HTTPStatus.BAD_REQUEST)
+            return
 
-        parsed_url = urlparse(self.path)
-        logging.debug(f"parsed_url: {parsed_url.path}")
         query_params = parse_qs(parsed_url.query)
-        logging.debug(f"query_params: {query_params}")
+        if debug_enabled():
+            logging.debug(f"parsed_url: {parsed_url.path}")
+            logging.debug(f"query_params: {query_params}")
 
         if parsed_url.path == '/stats':
             self.handle_stats_request(query_params)
+        elif parsed_url.path == '/stats/batch':
+            self.handle_db_request(query_params)
+        elif parsed_url.path == '/fleet':
+            self.handle_fleet_request(query_params)
+        elif parsed_url.path == '/machines':
+            self.handle_machines_request(query_params)
+        elif parsed_url.path == '/metrics':
+            self.handle_metrics_request()
         elif parsed_url.path == '/test':
             self.handle_test_request()
         else:
+            self.handle_static_request(parsed_url.path, query_params)
+
+    def send_response(self, code, message=None):
+        metrics.REQUESTS.inc(endpoint=self.endpoint, code=int(code))
+        super().send_response(code, message)
+
+    def handle_static_request(self, url_path: str, query_params: dict) -> None:
+        """ Serve file from memory, files missing there are left to SimpleHTTPRequestHandler """
+        asset = self.server.static.get(url_path)
+        if asset is None:
             super().do_GET()
+            return
+
+        cache_control = self.server.static.cache_control(asset, query_params)
+        if etag_matches(self.headers.get('If-None-Match'), asset.etag):
+            self.send_not_modified(asset.etag, cache_control)
+            return
+
+        gzipped = asset.gzipped is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        data = asset.gzipped if gzipped else asset.data
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', asset.etag)
+        self.send_header('Cache-Control', cache_control)
+        if asset.gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(data)
+        metrics.RESPONSE_BYTES.observe(len(data), endpoint=self.endpoint)
+
+    def handle_metrics_request(self) -> None:
+        # with --workers the values are sums over all server processes
+        data = metrics.REGISTRY.render()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
 
     def handle_test_request(self) -> None:
-        logging.getLogger().setLevel(logging.INFO)
+        log_level = logging.getLogger().level
+        logging.getLogger().setLevel(max(log_level, logging.INFO))
         logging.info(f"Testing request 2 weeks data")
 
         with self.server.vastdb as vastdb:
             machines_list = vastdb.table_to_df('machine_host_map').machine_id.sample(10)
 
-        times = []
+        times = {'pandas': [], 'sql': []}
         for machine_id in machines_list:
-            start = time()
             with self.server.vastdb as vastdb:
                 # json_data = vastdb.get_machine_stats(machine_id, datetime_to_ts('2024-03-06'), None)
                 # json_data = vastdb.get_machine_stats(machine_id, datetime_to_ts('2024'), None)
-                json_data = vastdb.get_machine_stats(machine_id)
-            times.append(time_ms(time() - start))
-            logging.info(f"machine_id: {machine_id} {times[-1]}ms")
+                start = time()
+                vastdb.get_machine_stats_pandas(machine_id)
+                times['pandas'].append(time_ms(time() - start))
+                start = time()
+                vastdb.get_machine_stats_sql(machine_id)
+                times['sql'].append(time_ms(time() - start))
+            logging.info(f"machine_id: {machine_id} pandas {times['pandas'][-1]}ms sql {times['sql'][-1]}ms")
 
-        logging.getLogger().setLevel(logging.DEBUG)
-        times = pd.Series(times)
-        msg = f"Request finished in {int(times.mean())} ± {int(times.std())}ms"
+        logging.getLogger().setLevel(log_level)
+        msg = '<br>'.join([f"Request finished in {int(pd.Series(t).mean())} ± {int(pd.Series(t).std())}ms ({engine})"
+                           for engine, t in times.items()])
         logging.debug(msg)
+        msg += f"<br>Cache: {self.server.cache.stats()}"
 
         html_content = f'<html><body>{msg}</body></html>'
         self.send_html(html_content.encode('utf-8'))
@@ -129,38 +326,154 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         with self.server.vastdb as vastdb:
             try:
                 machine_id, from_ts, to_ts = parse_params(query_params)
+                fmt = parse_format(query_params)
+                points = parse_points(query_params)
+                resolution = parse_resolution(query_params)
+                since = parse_since(query_params)
+                align = parse_flag(query_params, 'align')
+                fields = parse_fields(query_params, vastdb.registry)
+                if accepts_binary(self.headers):
+                    fmt = 'binary'
+                # chunked transfer encoding needs HTTP/1.1 client
+                stream = (parse_flag(query_params, 'stream') and fmt != 'binary' and not align
+                          and self.request_version != 'HTTP/1.0')
             except ValueError as e:
                 self.send_error(HTTPStatus.BAD_REQUEST, f'Error parsing params {query_params} {e}', str(e))
+                return
+
+            cache = self.server.cache
+            # snapshot tables are reloaded in background after data version changes,
+            # responses built before and after the reload of machine's rows must not share cache entry
+            cache_key = (machine_id, from_ts, to_ts, fmt, points, resolution, align, fields_key(fields),
+                         tuple(vastdb.snapshot_timestamps(machine_id).values()))
+            if since:
+                cache_key += tuple(since.values())
+            version = vastdb.data_version()
+
+            # tables only grow, so response can't change while latest timestamps stay the same
+            etag = make_etag(ETAG_SEED, cache_key, vastdb.last_timestamps(machine_id, version),
+                             vastdb.rollup and vastdb.rollup.generation)
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_not_modified(etag)
+                return
+
+            content_type = const.BINARY_MIME if fmt == 'binary' else 'application/json'
+            # rows newer than this are not rolled up yet, so missing from tiers serving the response
+            rollup_until = None if since and not align else vastdb.rollup_until(from_ts, to_ts, resolution)
+            headers = {'X-Rollup-Until': rollup_until} if rollup_until else None
+            if since:
+                # deltas are small and differ for every client, so they skip the cache
+                try:
+                    with self.server.admission.admit():
+                        if align:
+                            data = vastdb.get_machine_aligned(machine_id, from_ts, to_ts, fmt, points, resolution,
+                                                              since, version, fields)
+                        else:
+                            data = vastdb.get_machine_delta(machine_id, since, from_ts, to_ts, fmt, version, fields)
+                        compressed = compress_data(data)
+                except Overloaded as e:
+                    self.send_overloaded(e)
+                    return
+                except (sqlite3.DatabaseError, pd.errors.DatabaseError) as e:
+                    self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'DatabaseError {query_params}', str(e))
+                    return
+                self.send_compressed_json(compressed, content_type, etag, headers)
+                return
+
+            cache.validate(version)
+            compressed = cache.get(cache_key)
+            if compressed is not None:
+                if debug_enabled():
+                    logging.debug(f"[CACHE] hit {cache_key}")
+                self.send_compressed_json(compressed, content_type, etag, headers)
+                return
+
+            if stream:
+                try:
+                    with self.server.admission.admit():
+                        self.send_compressed_stream(vastdb.iter_machine_stats(machine_id, from_ts, to_ts, fmt, points,
+                                                                              resolution, fields),
+                                                    etag=etag, headers=headers)
+                except Overloaded as e:
+                    self.send_overloaded(e)
+                except Exception as e:
+                    # headers are already sent, client gets truncated response
+                    logging.error(f"Error streaming {query_params}: {get_error_info(e)}")
+                    self.close_connection = True
+                return
+
+            def compute():
+                if align:
+                    return vastdb.get_machine_aligned(machine_id, from_ts, to_ts, fmt, points, resolution,
+                                                      fields=fields)
+                return vastdb.get_machine_stats(machine_id, from_ts, to_ts, fmt, points, resolution, fields)
 
             try:
-                json_data = vastdb.get_machine_stats(machine_id, from_ts, to_ts)
+                compressed = self.compute_response(cache_key, version, compute)
+            except Overloaded as e:
+                self.send_overloaded(e)
+                return
             except pd.errors.DatabaseError as e:
                 self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
                                 f'Pandas DatabaseError {e}', str(e))
-
-            try:
-                compressed = compress_data(json_data)
-                self.send_compressed_json(compressed)
+                return
             except Exception as e:
                 self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'Error compressing json {query_params}', str(e))
-
-    def handle_db_request(self, query_params: dict, db_table: str) -> None:
+                return
+            self.send_compressed_json(compressed, content_type, etag, headers)
+
+    def compute_response(self, cache_key: tuple, version, compute) -> bytes:
+        """
+        Compressed response of compute(), stored in cache. Concurrent requests
+        with the same key and data version wait for the first one and share
+        its bytes, only that one goes through admission control.
+        :raise Overloaded: no admission slot for the computation
+        """
+        def run():
+            with self.server.admission.admit():
+                compressed = compress_data(compute())
+            self.server.cache.put(cache_key, compressed, version)
+            return compressed
+
+        compressed, shared = self.server.flights.do((cache_key, version), run)
+        if shared:
+            metrics.COALESCED.inc(endpoint=self.endpoint)
+        return compressed
+
+    def handle_db_request(self, query_params: dict) -> None:
+        """ Stats of several machines, given as list of machine_id or by host_id """
         try:
-            with sqlite3.connect(self.server.db_path) as conn:
-                sql_query = get_dbrequest_sql(query_params, db_table)
+            machine_ids, host_id, from_ts, to_ts = parse_batch_params(query_params)
+            fmt = parse_format(query_params)
+            points = parse_points(query_params)
+            resolution = parse_resolution(query_params)
 
-                start = time()
-                df = pd.read_sql_query(sql_query, conn)
-                logging.debug(f"sql request: {time_ms(time() - start)} ms")
+            with self.server.vastdb as vastdb:
+                fields = parse_fields(query_params, vastdb.registry)
+                if machine_ids is None:
+                    machine_ids = vastdb.get_host_machines(host_id)[:const.MAX_BATCH]
+                    if not machine_ids:
+                        self.send_error(HTTPStatus.NOT_FOUND, f'No machines found for host_id {host_id}')
+                        return
+
+                cache = self.server.cache
+                cache_key = ('batch', tuple(machine_ids), from_ts, to_ts, fmt, points, resolution, fields_key(fields),
+                             tuple(tuple(vastdb.snapshot_timestamps(mid).values()) for mid in machine_ids))
+                version = vastdb.data_version()
+                cache.validate(version)
+                compressed = cache.get(cache_key)
+                if compressed is None:
+                    compressed = self.compute_response(cache_key, version, lambda: vastdb.get_machines_stats(
+                        machine_ids, from_ts, to_ts, fmt, points, resolution, fields))
 
-            json_data = df.to_json(orient='records').encode('utf-8')
-            compressed = compress_data(json_data)
             self.send_compressed_json(compressed)
 
+        except Overloaded as e:
+            self.send_overloaded(e)
         except sqlite3.DatabaseError as e:
-            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'SQLite DatabaseError {query_params} {db_table}', str(e))
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'SQLite DatabaseError {query_params}', str(e))
         except pd.errors.DatabaseError as e:
-            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'Pandas DatabaseError {query_params} {sql_query} {db_table}', str(e))
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'Pandas DatabaseError {query_params}', str(e))
         except ValueError as e:
             self.send_error(HTTPStatus.BAD_REQUEST, f'ValueError during Parsing {query_params}', str(e))
         except TypeError as e:
@@ -170,6 +483,49 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, 'GET General exception', str(e))
 
+    def handle_fleet_request(self, query_params: dict) -> None:
+        try:
+            from_ts, to_ts = parse_fleet_params(query_params)
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, f'Error parsing params {query_params} {e}', str(e))
+            return
+
+        with self.server.vastdb as vastdb:
+            cache = self.server.cache
+            cache_key = ('fleet', from_ts, to_ts)
+            version = vastdb.data_version()
+            cache.validate(version)
+            compressed = cache.get(cache_key)
+            if compressed is None:
+                try:
+                    compressed = self.compute_response(cache_key, version,
+                                                       lambda: get_fleet_stats(vastdb.conn, from_ts, to_ts))
+                except Overloaded as e:
+                    self.send_overloaded(e)
+                    return
+                except (sqlite3.DatabaseError, pd.errors.DatabaseError) as e:
+                    self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'DatabaseError {query_params}', str(e))
+                    return
+
+        self.send_compressed_json(compressed)
+
+    def handle_machines_request(self, query_params: dict) -> None:
+        """ Machine id autocomplete: ids starting with given prefix """
+        try:
+            prefix, limit = parse_machines_params(query_params)
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, f'Error parsing params {query_params} {e}', str(e))
+            return
+
+        with self.server.vastdb as vastdb:
+            try:
+                machine_ids = vastdb.find_machines(prefix, limit)
+            except sqlite3.DatabaseError as e:
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'SQLite DatabaseError {query_params}', str(e))
+                return
+
+        self.send_compressed_json(compress_data(json.dumps(machine_ids).encode('utf-8')))
+
     def send_html(self, html_content):
         # Send HTML response to client
         self.send_response(HTTPStatus.OK)
@@ -177,12 +533,168 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(html_content)
 
-    def send_compressed_json(self, compressed_data):
+    def send_overloaded(self, e: Overloaded):
+        self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.send_header('Retry-After', str(e.retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_not_modified(self, etag: str, cache_control: str = 'no-cache'):
+        self.send_response(HTTPStatus.NOT_MODIFIED)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Vary', 'Accept')
+        self.end_headers()
+
+    def send_compressed_stream(self, chunks, content_type='application/json', etag=None, headers: dict = None):
+        """
+        Send str chunks with chunked transfer encoding, gzipped on the fly.
+        Compressor is flushed after every chunk, so client receives each one
+        as soon as it is generated.
+        """
+        # chunked encoding is only valid in HTTP/1.1 response
+        self.protocol_version = 'HTTP/1.1'
         self.send_response(HTTPStatus.OK)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
         self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Vary', 'Accept')
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        start = time()
+        size = 0
+        sent = 0
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = chunk.encode('utf-8')
+            size += len(data)
+            sent += self.write_chunk(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+        sent += self.write_chunk(compressor.flush())
+        self.wfile.write(b'0\r\n\r\n')
+        metrics.RESPONSE_BYTES.observe(sent, endpoint=self.endpoint)
+        if debug_enabled():
+            logging.debug(f"streamed {size} bytes in {time_ms(time() - start)} ms")
+
+    def write_chunk(self, data: bytes) -> int:
+        if data:
+            self.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+        return len(data)
+
+    def send_compressed_json(self, compressed_data, content_type='application/json', etag=None, headers: dict = None):
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept')
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(compressed_data)
+        metrics.RESPONSE_BYTES.observe(len(compressed_data), endpoint=self.endpoint)
+
+
+def prepare_database(db_path: str, rollup_path: str | None, create_indexes=True, strict=False):
+    """
+    One-time startup work needing write access, done before any server
+    process opens its connections: missing indexes and rollup database,
+    which has to exist before read-only connections attach it.
+    """
+    vastdb = VastDB(db_path)
+    try:
+        vastdb.check_schema(create_indexes=create_indexes, strict=strict)
+    finally:
+        vastdb.close()
+    if rollup_path:
+        Rollup(db_path, rollup_path).init_schema()
+
+
+def start_services(httpd, args: dict, leader=True):
+    """ Database access, caches and background threads of one server process """
+    db_path = args.get('db_path')
+    httpd.rollup = None
+    if args.get('rollup_path'):
+        httpd.rollup = Rollup(db_path, args.get('rollup_path'))
+        httpd.rollup.start(update=leader)
+
+    httpd.archive = None
+    if args.get('archive_path'):
+        httpd.archive = Archive(db_path, args.get('archive_path'))
+        httpd.archive.start(update=leader)
+
+    httpd.snapshots = None
+    if not args.get('no_snapshots'):
+        httpd.snapshots = SnapshotStore(db_path)
+        httpd.snapshots.start()
+
+    httpd.vastdb = VastDB(db_path, rollup=httpd.rollup, snapshots=httpd.snapshots, archive=httpd.archive)
+    # every worker process has its own cache, --cache_size is their total
+    httpd.cache = LRUCache(args.get('cache_size') * 1024 * 1024 // (args.get('workers') or 1))
+    httpd.flights = SingleFlight()
+    httpd.admission = Admission(args.get('max_active'), args.get('max_queue'))
+    httpd.static = StaticAssets(const.STATIC_PATH)
+    metrics.REGISTRY.add_collector(lambda: collect_metrics(httpd))
+
+
+def collect_metrics(httpd):
+    """ Copy state of cache and admission control into their metrics """
+    stats = httpd.cache.stats()
+    metrics.CACHE_ENTRIES.set(stats['entries'])
+    metrics.CACHE_BYTES.set(stats['size'])
+    metrics.CACHE_LOOKUPS.set(stats['hits'], result='hit')
+    metrics.CACHE_LOOKUPS.set(stats['misses'], result='miss')
+    metrics.ADMISSION_ACTIVE.set(httpd.admission.active)
+    metrics.ADMISSION_WAITING.set(httpd.admission.waiting)
+
+
+def stop_services(httpd):
+    metrics.REGISTRY.stop()
+    httpd.vastdb.close()
+    if httpd.rollup:
+        httpd.rollup.stop()
+    if httpd.archive:
+        httpd.archive.stop()
+    if httpd.snapshots:
+        httpd.snapshots.stop()
+
+
+def serve(httpd, args: dict, leader=True) -> int:
+    """
+    Serve until SIGTERM or keyboard interrupt. Server stops accepting
+    connections, finishes requests in progress and only then closes
+    database connections.
+    :param leader: run rollup updates and archive exports in this process, only one process may do it
+    :return: exit code
+    """
+    def sigterm_handler(signum, frame):
+        logging.warning("[SIGTERM] Stopping server ...")
+        # shutdown() waits for serve_forever() running in this very thread
+        threading.Thread(target=httpd.shutdown).start()
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    start_services(httpd, args, leader)
+
+    code = 0
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logging.debug("Keyboard interrupt received, stopping server ...")
+    except Exception as e:
+        logging.error(get_error_info(e))
+        code = 1
+    finally:
+        # waits for in-flight requests
+        httpd.server_close()
+        stop_services(httpd)
+        logging.info("[SIGTERM] Server stopped")
+    return code
 
 
 if __name__ == "__main__":
@@ -190,11 +702,51 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--port', type=int, default=3000, help='port to listen on')
     parser.add_argument('--db_path', type=str, default='./vast.db', help='path to database')
     parser.add_argument('--log_path', type=str, default='./server.log', help='path to log file')
+    parser.add_argument('-t', '--threads', type=int, default=const.MAX_THREADS,
+                        help='max number of requests served concurrently, as many connections more may wait '
+                             'for a thread, further ones are answered with 503')
+    parser.add_argument('--no_indexes', action='store_true',
+                        help='do not create missing (machine_id, timestamp) indexes at startup')
+    parser.add_argument('--strict_schema', action='store_true',
+                        help='refuse to start if any /stats query does full table scan')
+    parser.add_argument('--cache_size', type=int, default=const.CACHE_SIZE_MB,
+                        help='size of /stats response cache in Mb, split between workers, 0 to disable')
+    parser.add_argument('--log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='logging level, DEBUG logs timings of every request')
+    parser.add_argument('--rollup_path', type=str, default=None,
+                        help='path to hourly/daily rollup database, rollups are disabled if not set')
+    parser.add_argument('--archive_path', type=str, default=None,
+                        help='directory of columnar archive of old time series, archive is disabled if not set')
+    parser.add_argument('--no_snapshots', action='store_true',
+                        help='read snapshot tables from database instead of memory')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of server processes sharing the port, each with its own threads, '
+                             'cache size and admission limits are split between them, '
+                             '/metrics reports sums over all of them')
+    parser.add_argument('--max_active', type=int, default=None,
+                        help='responses computed from database at once, split between workers, '
+                             f'threads * {const.ADMISSION_ACTIVE_SHARE:g} per worker by default')
+    parser.add_argument('--max_queue', type=int, default=None,
+                        help='computations waiting for a free slot, more are answered with 503, '
+                             f'split between workers, threads * {const.ADMISSION_QUEUE_SHARE:g} per worker by default')
 
     args = vars(parser.parse_args())
     db_path = args.get('db_path')
     log_path = args.get('log_path')
     port = args.get('port')
+    threads = args.get('threads')
+    cache_size = args.get('cache_size')
+    rollup_path = args.get('rollup_path')
+    workers = args.get('workers')
+    # limits given for the whole server are split between worker processes, defaults are per process
+    if args.get('max_active') is None:
+        args['max_active'] = max(1, int(threads * const.ADMISSION_ACTIVE_SHARE))
+    else:
+        args['max_active'] = max(1, args['max_active'] // workers)
+    if args.get('max_queue') is None:
+        args['max_queue'] = max(1, int(threads * const.ADMISSION_QUEUE_SHARE))
+    else:
+        args['max_queue'] = max(1, args['max_queue'] // workers)
 
     # logging
     log_handler = None
@@ -203,44 +755,37 @@ if __name__ == "__main__":
                                    backupCount=const.LOG_COUNT)
     log_handler = [rotating]
 
-    log_level = logging.DEBUG
-    logging.basicConfig(format=const.LOG_FORMAT,
+    log_level = getattr(logging, args.get('log_level'))
+    logging.basicConfig(format=const.LOG_FORMAT if workers <= 1 else const.LOG_FORMAT_WORKERS,
                         handlers=log_handler,
                         level=log_level,
                         datefmt='%d-%m-%Y %I:%M:%S')
 
-    with socketserver.TCPServer(("", port), RequestHandler) as httpd:
-        httpd.allow_reuse_address = True
-
-        def sigterm_handler(signum, frame):
-            logging.warning("[SIGTERM] Stopping server ...")
-
-            httpd.vastdb.close()
-
-            # shutdown in separate thread
-            threading.Thread(target=httpd.shutdown).start()
-
-            logging.info("[SIGTERM] Server stopped")
-            sys.exit(0)
-
-        signal.signal(signal.SIGTERM, sigterm_handler)
-
-        httpd.vastdb = VastDB(db_path)
+    with ThreadPoolHTTPServer(("", port), RequestHandler, max_threads=threads) as httpd:
+        try:
+            prepare_database(db_path, rollup_path, create_indexes=not args.get('no_indexes'),
+                             strict=args.get('strict_schema'))
+        except Exception as e:
+            logging.error(f"Schema check failed: {get_error_info(e)}")
+            sys.exit(1)
         logging.debug(f"Database path: {db_path}")
-        logging.debug(f"Server listening on port {port}")
+        logging.debug(f"Server listening on port {port} with {threads} threads")
 
-        try:
-            httpd.serve_forever()
+        if workers > 1:
+            # idle workers must not block in accept() when another one took the connection
+            httpd.socket.setblocking(False)
+            # every worker saves its metrics here, /metrics of any worker sums them
+            metrics_dir = tempfile.mkdtemp(prefix='vast-metrics-')
 
-        except KeyboardInterrupt:
-            logging.debug("Keyboard interrupt received, stopping server ...")
-            httpd.vastdb.close()
-            threading.Thread(target=httpd.shutdown).start()
-            logging.debug("Server stopped")
-            sys.exit(0)  # Optional, to exit the script after cleanup
+            def run_worker(idx: int) -> int:
+                metrics.REGISTRY.share(metrics_dir, idx, const.METRICS_SHARE_INTERVAL)
+                return serve(httpd, args, leader=idx == 0)
 
-        except Exception as e:
-            logging.debug(get_error_info(e))
-            httpd.vastdb.close()
-            threading.Thread(target=httpd.shutdown).start()
-            sys.exit(1)
+            supervisor = Supervisor(workers, run_worker)
+            try:
+                code = supervisor.run()
+            finally:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
+            sys.exit(code)
+
+        sys.exit(serve(httpd, args))
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from src import const
+
+
+class Overloaded(Exception):
+    """ Request rejected by admission control, client should retry after retry_after seconds """
+    def __init__(self, retry_after: int):
+        super().__init__(f"server overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with equal key share one computation: the first caller
+    runs it, the others wait and get its result, or its exception raised
+    again. Keys are forgotten as soon as the computation finishes, results
+    are kept by the response cache, not here.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, func) -> tuple:
+        """ :return: result of func(), True if it was computed by another caller """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+class Admission:
+    """
+    Bound on expensive work (responses not found in cache): at most
+    max_active computations run at once, at most max_queue more wait up to
+    const.ADMISSION_TIMEOUT for a free slot, anything beyond is rejected
+    right away with Overloaded. A burst of slow requests therefore holds
+    at most max_active + max_queue server threads, the remaining ones keep
+    serving cached responses, static files and metrics.
+    Limits hold within one process, with --workers the server-wide
+    --max_active and --max_queue are split between workers.
+    """
+    def __init__(self, max_active: int, max_queue: int, timeout: float = const.ADMISSION_TIMEOUT,
+                 retry_after: int = const.RETRY_AFTER):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(max_active)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.max_queue:
+                    raise Overloaded(self.retry_after)
+                self.waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not acquired:
+                logging.warning(f"[ADMISSION] No free slot in {self.timeout}s, rejecting")
+                raise Overloaded(self.retry_after)
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._slots.release()
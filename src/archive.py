@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import os
+import json
+import shutil
+import logging
+import sqlite3
+import threading
+from time import time
+
+import numpy as np
+
+from src import const
+from src import schema
+from src.utils import LazyModule, time_ms, get_error_info, ts_utc_now, np_group_slices
+
+pd = LazyModule('pandas')
+
+META_FILE = 'meta.json'
+INDEX_FILES = ('machine_ids.npy', 'offsets.npy')
+
+
+class Partition:
+    """
+    Rows of one table within [start, end), sorted by machine_id, timestamp,
+    one .npy file per column. Rows of machine_ids[i] are offsets[i]:offsets[i+1].
+    Column files are memory-mapped on first use.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.start = meta['start']
+        self.end = meta['end']
+        self.rows = meta['rows']
+        # {column: True if integer column stored as float because of NULLs}
+        self.columns = meta['columns']
+        self.machine_ids = np.load(os.path.join(path, INDEX_FILES[0]))
+        self.offsets = np.load(os.path.join(path, INDEX_FILES[1]))
+        self._arrays = {}
+
+    def array(self, col: str) -> np.ndarray:
+        arr = self._arrays.get(col)
+        if arr is None:
+            arr = self._arrays[col] = np.load(os.path.join(self.path, f'{col}.npy'), mmap_mode='r')
+        return arr
+
+    def bounds(self, machine_id: int, from_ts=None, to_ts=None) -> tuple:
+        """ Row range of machine within [from_ts, to_ts] """
+        i = np.searchsorted(self.machine_ids, machine_id)
+        if i == len(self.machine_ids) or self.machine_ids[i] != machine_id:
+            return 0, 0
+        lo, hi = int(self.offsets[i]), int(self.offsets[i + 1])
+        if (from_ts and from_ts > self.start) or (to_ts and to_ts < self.end - 1):
+            ts = self.array('timestamp')[lo:hi]
+            if from_ts and from_ts > self.start:
+                lo, hi = lo + np.searchsorted(ts, from_ts, side='left'), hi
+                ts = self.array('timestamp')[lo:hi]
+            if to_ts and to_ts < self.end - 1:
+                hi = lo + np.searchsorted(ts, to_ts, side='right')
+        return lo, hi
+
+
+class PartitionWriter:
+    """
+    New partition of known size, columns written into memmapped .npy files
+    of a temporary directory that is renamed to `path` by close().
+    """
+    def __init__(self, path: str, start: int, end: int, rows: int, dtypes: dict, nulls: dict):
+        """ :param nulls: {column: True if integer column stored as float because of NULLs} """
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.meta = {'start': start, 'end': end, 'rows': rows, 'columns': nulls}
+        self.dtypes = dtypes
+        self.pos = 0
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.arrays = {col: np.lib.format.open_memmap(os.path.join(self.tmp_path, f'{col}.npy'), mode='w+',
+                                                      dtype=dtype, shape=(rows,)) for col, dtype in dtypes.items()}
+
+    def append(self, df: pd.DataFrame):
+        # rows committed after counting are left out
+        n = min(len(df), self.meta['rows'] - self.pos)
+        for col, arr in self.arrays.items():
+            arr[self.pos:self.pos + n] = df[col].to_numpy(dtype=self.dtypes[col], na_value=np.nan)[:n]
+        self.pos += n
+
+    def close(self):
+        machine_ids, starts = np.unique(self.arrays['machine_id'][:self.pos], return_index=True)
+        np.save(os.path.join(self.tmp_path, INDEX_FILES[0]), machine_ids)
+        np.save(os.path.join(self.tmp_path, INDEX_FILES[1]), np.append(starts, self.pos))
+        for arr in self.arrays.values():
+            arr.flush()
+        self.arrays = {}
+        with open(os.path.join(self.tmp_path, META_FILE), 'w') as f:
+            json.dump({**self.meta, 'rows': self.pos}, f)
+        # re-export replaces the partition, readers keep their maps of the removed files
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+
+class Archive:
+    """
+    Cold history of time series tables as memory-mapped columnar files.
+
+    Time is split into partitions of const.ARCHIVE_PARTITION seconds.
+    Partitions that ended more than const.ARCHIVE_SEAL_AGE ago are sealed:
+    collector doesn't write there anymore, so they are exported once into
+    `archive_path/<table>/<start>/`, written to a temporary directory and
+    renamed when complete. SQLite keeps all rows, archive is a copy that
+    reads of old ranges come from: slices of mmapped arrays instead of
+    decoding rows, sharing OS page cache between server processes.
+
+    Like Rollup, one process runs updates (start(update=True)) and the
+    others only rescan exported partitions.
+    """
+    def __init__(self, db_path: str, archive_path: str, tables: list = None):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.tables = tables or const.ARCHIVE_TABLES
+        self._partitions = {}
+        self._sealed = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect_raw(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+
+    def load(self):
+        """ Scan exported partitions, archive covers tables up to the first gap """
+        partitions = {}
+        sealed = {}
+        for tbl_name in self.tables:
+            tbl_path = os.path.join(self.archive_path, tbl_name)
+            names = os.listdir(tbl_path) if os.path.isdir(tbl_path) else []
+            loaded = {p.start: p for p in self._partitions.get(tbl_name, [])}
+            parts = []
+            for name in sorted([name for name in names if name.isdigit()], key=int):
+                part = loaded.get(int(name)) or Partition(os.path.join(tbl_path, name))
+                if parts and part.start != parts[-1].end:
+                    break
+                parts.append(part)
+            partitions[tbl_name] = parts
+            if parts:
+                sealed[tbl_name] = parts[-1].end
+        self._partitions = partitions
+        self._sealed = sealed
+
+    def sealed_until(self, tbl_name: str) -> int | None:
+        """ Rows of the table before this timestamp are in the archive """
+        return self._sealed.get(tbl_name)
+
+    def covers(self, tbl_name: str, from_ts=None) -> bool:
+        sealed = self._sealed.get(tbl_name)
+        return sealed is not None and (from_ts or 0) < sealed
+
+    def read(self, tbl_name: str, machine_id, from_ts=None, to_ts=None, columns: list = None) -> pd.DataFrame:
+        """
+        Archived rows of single machine_id or list of them, ordered by machine_id, timestamp.
+        Columns of rows within one partition are read-only views of the mapped
+        files, callers modifying values in place have to copy the frame first.
+        :param columns: columns to read, all if not given
+        """
+        parts = [p for p in self._partitions.get(tbl_name, [])
+                 if (not from_ts or from_ts < p.end) and (not to_ts or to_ts >= p.start)]
+        if not parts:
+            return pd.DataFrame(columns=columns)
+        columns = columns or list(parts[0].columns)
+        machine_ids = sorted(machine_id) if isinstance(machine_id, (list, tuple)) else [machine_id]
+
+        slices = [(p, *p.bounds(mid, from_ts, to_ts)) for mid in machine_ids for p in parts]
+        slices = [(p, lo, hi) for p, lo, hi in slices if hi > lo]
+        if not slices:
+            # same as empty result of SQLite, without dtypes
+            return pd.DataFrame(columns=columns)
+        data = {}
+        for col in columns:
+            views = [p.array(col)[lo:hi] for p, lo, hi in slices]
+            vals = views[0] if len(views) == 1 else np.concatenate(views)
+            # same dtype as reading these rows from SQLite: int unless there are NULLs
+            if parts[0].columns[col] and not np.isnan(vals).any():
+                vals = vals.astype(np.int64)
+            data[col] = vals
+        return pd.DataFrame(data, copy=False)
+
+    def export(self, raw: sqlite3.Connection, tbl_name: str, start: int, end: int) -> int:
+        """
+        Write partitions of rows start <= timestamp < end in one pass. Rows of
+        every machine are read by index seek in timestamp order and appended to
+        the partitions they fall into, so each partition is sorted by
+        machine_id, timestamp without sorting the table.
+        :return: number of rows
+        """
+        period = const.ARCHIVE_PARTITION
+        columns = schema.table_columns(raw, tbl_name)
+        cte = schema.machine_ids_cte(tbl_name)
+        where = f"t.timestamp >= {start} AND t.timestamp < {end}"
+        checks = ', '.join([f'max(typeof(t."{col}") = \'real\'), max(typeof(t."{col}") IN (\'text\', \'blob\')), '
+                            f'max(t."{col}" IS NULL)' for col in columns])
+        stats = {row[0]: row[1:] for row in raw.execute(
+            f"{cte}SELECT t.timestamp / {period} * {period}, count(*), {checks} "
+            f"FROM ids CROSS JOIN {tbl_name} t ON t.machine_id = ids.machine_id WHERE {where} GROUP BY 1")}
+
+        writers = {}
+        for part_start in range(start, end, period):
+            row = stats.get(part_start, (0,) + (0,) * 3 * len(columns))
+            dtypes, nulls = {}, {}
+            for i, col in enumerate(columns):
+                is_real, is_text, has_null = [bool(v) for v in row[1 + 3 * i: 4 + 3 * i]]
+                if is_text:
+                    raise ValueError(f"{tbl_name}.{col} is not numeric, table can't be archived")
+                dtypes[col] = np.float64 if is_real or has_null else np.int64
+                nulls[col] = has_null and not is_real
+            path = os.path.join(self.archive_path, tbl_name, str(part_start))
+            writers[part_start] = PartitionWriter(path, part_start, part_start + period, row[0], dtypes, nulls)
+
+        machine_ids = [row[0] for row in raw.execute(f"{cte}SELECT machine_id FROM ids WHERE machine_id IS NOT NULL")]
+        sql_query = (f"SELECT * FROM {tbl_name} WHERE machine_id = ? "
+                     f"AND timestamp >= {start} AND timestamp < {end} ORDER BY timestamp")
+        rows = []
+        n_rows = 0
+        for machine_id in machine_ids:
+            if self._stop.is_set():
+                return n_rows
+            rows += raw.execute(sql_query, (machine_id,)).fetchall()
+            if len(rows) >= const.ARCHIVE_CHUNK_ROWS:
+                n_rows += self._write_rows(writers, rows, columns)
+                rows = []
+        n_rows += self._write_rows(writers, rows, columns)
+
+        for writer in writers.values():
+            writer.close()
+        return n_rows
+
+    @staticmethod
+    def _write_rows(writers: dict, rows: list, columns: list) -> int:
+        """ Append rows ordered by machine_id, timestamp to writers of their partitions """
+        if not rows:
+            return 0
+        chunk = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        parts = chunk.timestamp.values // const.ARCHIVE_PARTITION * const.ARCHIVE_PARTITION
+        # stable sort keeps machine_id, timestamp order within each partition
+        order = np.argsort(parts, kind='stable')
+        bounds = np.append(np_group_slices(parts[order]), len(order))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            writers[int(parts[order[lo]])].append(chunk.iloc[order[lo:hi]])
+        return len(rows)
+
+    def update(self) -> int:
+        """
+        Export sealed partitions following the last exported one of every table.
+        :return: number of exported partitions
+        """
+        start = time()
+        period = const.ARCHIVE_PARTITION
+        horizon = ts_utc_now() - const.ARCHIVE_SEAL_AGE
+        raw = self._connect_raw()
+        exported = 0
+        try:
+            for tbl_name in self.tables:
+                # first and last row of every machine are index seeks, min()/max() of the table would scan it
+                first_ts, last_ts = raw.execute(
+                    f"{schema.machine_ids_cte(tbl_name)}"
+                    f"SELECT min((SELECT min(timestamp) FROM {tbl_name} WHERE machine_id = ids.machine_id)), "
+                    f"max((SELECT max(timestamp) FROM {tbl_name} WHERE machine_id = ids.machine_id)) "
+                    f"FROM ids WHERE machine_id IS NOT NULL").fetchone()
+                if first_ts is None:
+                    continue
+                part_start = self._sealed.get(tbl_name, first_ts // period * period)
+                # partitions after the last row are exported once rows arrive there
+                part_end = min(horizon // period * period, (last_ts // period + 1) * period)
+                if part_end <= part_start or self._stop.is_set():
+                    continue
+                tbl_start = time()
+                rows = self.export(raw, tbl_name, part_start, part_end)
+                logging.debug(f"[ARCHIVE] {tbl_name} {part_start}-{part_end}: {rows} rows "
+                              f"{time_ms(time() - tbl_start)}ms")
+                if not self._stop.is_set():
+                    exported += (part_end - part_start) // period
+                self.load()
+        finally:
+            raw.close()
+
+        if exported:
+            logging.info(f"[ARCHIVE] {exported} partitions exported {time_ms(time() - start)}ms")
+        return exported
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.update()
+            except Exception as e:
+                logging.error(f"[ARCHIVE] Update failed: {get_error_info(e)}")
+            self._stop.wait(const.ARCHIVE_INTERVAL)
+
+    def follow(self):
+        while not self._stop.wait(const.ARCHIVE_REFRESH_INTERVAL):
+            try:
+                self.load()
+            except Exception as e:
+                logging.error(f"[ARCHIVE] Reload failed: {get_error_info(e)}")
+
+    def start(self, update: bool = True):
+        """ :param update: export new partitions, otherwise only follow the process doing it """
+        os.makedirs(self.archive_path, exist_ok=True)
+        self.load()
+        self._thread = threading.Thread(target=self.run if update else self.follow, name='archive', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
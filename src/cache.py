@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache of bytes values, bounded by their total size.
+    The whole cache is tied to a data version: when validate() sees a new
+    version all entries are dropped, and values computed for an outdated
+    version are not stored.
+    Cache belongs to one process, with --workers each worker gets its
+    share of --cache_size.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def validate(self, version) -> None:
+        with self._lock:
+            if version == self.version:
+                return
+            if self._data:
+                logging.debug(f"[CACHE] Data version changed {self.version} -> {version}, "
+                              f"dropping {len(self._data)} entries")
+            self._data.clear()
+            self.size = 0
+            self.version = version
+
+    def get(self, key) -> bytes | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value: bytes, version=None) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._data[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'size': self.size,
+                'max_size': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
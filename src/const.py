@@ -1,8 +1,112 @@
 # Define logging options
 LOG_FORMAT = '[%(asctime)s] [%(levelname)s] %(message)s'
+LOG_FORMAT_WORKERS = '[%(asctime)s] [%(process)d] [%(levelname)s] %(message)s'
 MAX_LOGSIZE = 1024 * 1024  # 1Mb
 LOG_COUNT = 3
 
 IP_LIST = ['89.79.244.70', '195.150.104.138', '127.0.0.1']
 
 STATIC_PATH = './static'
+
+# Server concurrency
+MAX_THREADS = 8
+PENDING_SHARE = 1           # connections waiting for a free thread per thread, more get 503
+
+# Admission control of responses computed from database (src/admission.py),
+# --max_active and --max_queue default to these shares of --threads
+ADMISSION_ACTIVE_SHARE = 0.5    # computations running at once
+ADMISSION_QUEUE_SHARE = 0.25    # computations waiting for a slot, more get 503
+ADMISSION_TIMEOUT = 10          # seconds to wait for a slot before 503
+RETRY_AFTER = 2                 # seconds, Retry-After of 503 responses
+
+# Pre-fork mode (--workers N), see src/prefork.py
+WORKER_DRAIN_TIMEOUT = 30       # seconds for workers to finish in-flight requests on SIGTERM
+WORKER_RESTART_DELAY = 1        # seconds before restart of crashed worker
+WORKER_MAX_RESTART_DELAY = 60   # delay doubles up to this while worker keeps crashing
+WORKER_MIN_UPTIME = 10          # worker exiting sooner is considered crashing on start
+WORKER_POLL_INTERVAL = 0.2
+METRICS_SHARE_INTERVAL = 5      # seconds between saves of worker metrics summed by /metrics
+
+# Tables served by /stats
+TS_TABLES = ['rent_ts', 'reliability_ts', 'cost_ts', 'hardware_ts', 'avg_ts']
+SNP_TABLES = ['eod_snp', 'disk_snp', 'cpu_ram_snp']
+
+# Max number of machines in one /stats/batch request
+MAX_BATCH = 100
+
+# In-memory snapshot tables (src/snapshots.py), reloaded when database changed
+SNAPSHOT_INTERVAL = 30      # seconds between checks of data version
+# Machine id autocomplete (/machines?prefix=)
+MACHINES_LIMIT = 20
+MACHINES_MAX_LIMIT = 1000
+
+# Column profiles of /stats?fields=: {profile: {table: [columns]}}, tables not listed are served whole.
+# 'dashboard' holds the columns static/script.js uses, timestamp is always kept
+FIELD_PROFILES = {
+    'dashboard': {
+        'rent_ts': ['timestamp', 'num_gpus_rented'],
+        'reliability_ts': ['timestamp', 'reliability'],
+        'cost_ts': ['timestamp', 'dph_base'],
+        'hardware_ts': ['timestamp', 'cpu_name', 'cpu_cores', 'mobo_name', 'num_gpus', 'gpu_name', 'gpu_ram',
+                        'gpu_lanes', 'pci_gen', 'total_flops', 'disk_name'],
+        'avg_ts': ['timestamp', 'gpu_mem_bw_avg', 'pcie_bw_avg', 'disk_bw_avg', 'inet_up_avg', 'inet_down_avg'],
+        'eod_snp': ['machine_id', 'public_ipaddr', 'country', 'isp', 'verification', 'direct_port_count'],
+        'disk_snp': ['disk_space'],
+        'cpu_ram_snp': ['cpu_ram'],
+    },
+    'all': {},
+}
+DEFAULT_FIELDS = 'dashboard'
+
+# /stats response formats, first one is the default
+FORMATS = ['records', 'columns']
+
+# Accept header value for packed binary /stats format, see src/packed.py
+BINARY_MIME = 'application/vnd.vast-stats.columns'
+
+# Max total size of cached compressed /stats responses
+CACHE_SIZE_MB = 64
+
+# Downsampling of time series (/stats?points=N)
+# continuous series are downsampled with min/max buckets: {table: value column},
+# other time series are step functions and downsampled by change points
+CONTINUOUS_TS = {'reliability_ts': 'reliability'}
+MIN_POINTS = 4
+
+# series of aligned /stats responses (/stats?align=1): {name: (table, column, divisor)},
+# values are divided to display units, cost is per GPU
+ALIGNED_SERIES = {
+    'reliability': ('reliability_ts', 'reliability', 100),
+    'rent': ('rent_ts', 'num_gpus_rented', 1),
+    'cost': ('cost_ts', 'dph_base', 1000),
+}
+
+# Rows per batch in streamed /stats responses (/stats?stream=1)
+STREAM_BATCH = 1000
+
+# Fleet-wide market aggregates (/fleet)
+FLEET_CHUNK_ROWS = 100_000      # rows per chunk of sql reads
+FLEET_DEFAULT_DAYS = 30         # range when 'from' is not given
+FLEET_MAX_DAYS = 366
+FLEET_RELIABILITY_DAYS = 1      # latest reliability is searched within this many days before 'to'
+FLEET_RELIABILITY_BINS = 20
+FLEET_QUANTILES = [5, 25, 50, 75, 95]
+FLEET_UNKNOWN_GPU = 'unknown'   # gpu_name group of machines without gpu_name
+
+# Rollups of time series (--rollup_path): {tier: bucket size in seconds}
+ROLLUP_TIERS = {'hour': 3600, 'day': 24 * 3600}
+# 'auto' resolution serves spans up to these lengths from raw or hourly table, longer ones from daily
+ROLLUP_SPANS = {'raw': 14 * 24 * 3600, 'hour': 120 * 24 * 3600}
+RESOLUTIONS = ['auto', 'raw'] + list(ROLLUP_TIERS)
+ROLLUP_INTERVAL = 300       # seconds between updates
+ROLLUP_LAG = 60             # rows younger than this are rolled up in the next update
+ROLLUP_REFRESH_INTERVAL = 10    # seconds between metadata reloads of processes not running updates
+ROLLUP_CHUNK_ROWS = 100_000
+
+# Columnar archive of sealed partitions of numeric time series tables (--archive_path)
+ARCHIVE_TABLES = ['rent_ts', 'reliability_ts', 'cost_ts', 'avg_ts']
+ARCHIVE_PARTITION = 7 * 24 * 3600   # seconds per partition, aligned to epoch
+ARCHIVE_SEAL_AGE = 3 * 24 * 3600    # partitions ended longer ago than this get no new rows
+ARCHIVE_INTERVAL = 3600             # seconds between exports
+ARCHIVE_REFRESH_INTERVAL = 60       # seconds between rescans of processes not exporting
+ARCHIVE_CHUNK_ROWS = 100_000
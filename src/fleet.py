@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+from time import time
+
+import numpy as np
+
+from src import const
+from src import schema
+from src.utils import LazyModule, time_ms, round_day, np_argmax_reduceat, np_group_slices
+
+pd = LazyModule('pandas')
+
+DAY = 24 * 3600
+
+
+def np_latest(keys: np.ndarray, ts: np.ndarray) -> np.ndarray:
+    """
+    Index of the latest row of every key, keys don't have to be sorted
+    :param keys: group key of every row (machine_id etc.)
+    :param ts: timestamps of rows
+    :return: indices of rows with max timestamp in each group
+    """
+    order = np.argsort(keys, kind='stable')
+    slice_idx = np_group_slices(keys[order])
+    ts = ts[order]
+    # np_argmax_reduceat expects non-negative values
+    return order[np_argmax_reduceat(ts - ts.min(), slice_idx)]
+
+
+def machine_key(df: pd.DataFrame) -> np.ndarray:
+    return df.machine_id.values
+
+
+def day_machine_key(df: pd.DataFrame) -> np.ndarray:
+    days = round_day(df.timestamp) // DAY
+    return (days.astype(np.int64) << 32) | df.machine_id.values.astype(np.int64)
+
+
+def read_latest(conn: sqlite3.Connection, sql_query: str, key_func) -> pd.DataFrame:
+    """
+    Chunked read keeping only the latest row for each key. Every chunk is
+    reduced together with the result of previous chunks, so memory is bounded
+    by chunk size plus number of keys.
+    """
+    latest = None
+    for chunk in pd.read_sql(sql_query, conn, chunksize=const.FLEET_CHUNK_ROWS):
+        if chunk.empty:
+            continue
+        if latest is not None:
+            chunk = pd.concat([latest, chunk], ignore_index=True)
+        idx = np_latest(key_func(chunk), chunk.timestamp.values)
+        latest = chunk.iloc[idx].reset_index(drop=True)
+    return latest
+
+
+def range_query(tbl_name: str, columns: list, where: str) -> str:
+    """
+    Rows of every machine matching `where` on timestamp column `t.timestamp`,
+    read by index seek per machine instead of scanning the table
+    """
+    return (f"{schema.machine_ids_cte(tbl_name)}SELECT {', '.join([f't.{col}' for col in columns])} "
+            f"FROM ids CROSS JOIN {tbl_name} t ON t.machine_id = ids.machine_id WHERE {where}")
+
+
+def latest_query(tbl_name: str, columns: list, where: str) -> str:
+    """ Latest row of every machine among rows matching `where` on `timestamp`, two index seeks per machine """
+    return (f"{schema.machine_ids_cte(tbl_name)}SELECT {', '.join([f't.{col}' for col in columns])} "
+            f"FROM ids CROSS JOIN {tbl_name} t ON t.machine_id = ids.machine_id AND t.timestamp = "
+            f"(SELECT max(timestamp) FROM {tbl_name} WHERE machine_id = ids.machine_id AND {where})")
+
+
+def _update_state(state: np.ndarray, machine_ids: np.ndarray, df: pd.DataFrame, col: str):
+    """ Write values of df rows into state array of sorted machine_ids """
+    if df is None or df.empty:
+        return
+    idx = np.searchsorted(machine_ids, df.machine_id.values)
+    idx[idx == machine_ids.size] = 0
+    known = machine_ids[idx] == df.machine_id.values
+    state[idx[known]] = df[col].values[known]
+
+
+def iter_daily_state(conn, tbl_name: str, col: str, machine_ids: np.ndarray, days: np.ndarray, from_ts, to_ts):
+    """
+    Value of step series `col` of every machine at the end of each day,
+    forward filled from the last change. NaN when value is not known yet.
+    State array is updated in place and yielded for every day.
+    """
+    state = np.full(machine_ids.size, np.nan)
+
+    columns = ['machine_id', 'timestamp', col]
+    seed = read_latest(conn, latest_query(tbl_name, columns, f"timestamp < {from_ts}"), machine_key)
+    _update_state(state, machine_ids, seed, col)
+
+    changes = read_latest(conn, range_query(tbl_name, columns, f"t.timestamp >= {from_ts} AND t.timestamp <= {to_ts}"),
+                          day_machine_key)
+    if changes is None:
+        changes = pd.DataFrame(columns=['machine_id', 'timestamp', col])
+
+    change_days = round_day(changes.timestamp) if len(changes) else np.array([], dtype=np.int64)
+    order = np.argsort(change_days, kind='stable')
+    changes, change_days = changes.iloc[order], change_days[order]
+    bounds = np.searchsorted(change_days, days, side='right')
+
+    start = 0
+    for day, end in zip(days, bounds):
+        _update_state(state, machine_ids, changes.iloc[start:end], col)
+        start = end
+        yield state
+
+
+def _group_stats(vals: np.ndarray, order: np.ndarray, bounds: np.ndarray) -> tuple:
+    """
+    Median, mean and count of non-NaN values of every gpu group at once,
+    median and mean are NaN for groups without values
+    :return: lists of median, mean, count
+    """
+    vals = vals[order]
+    starts = bounds[:-1]
+    sizes = np.diff(bounds)
+    known = ~np.isnan(vals)
+    counts = np.add.reduceat(known, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(known, vals, 0), starts) / counts
+    # sort values within every group, NaN go last, middle values are at fixed offsets from group start
+    group = np.repeat(np.arange(starts.size), sizes)
+    vals = vals[np.lexsort((vals, group))]
+    median = (vals[starts + np.maximum(counts - 1, 0) // 2] + vals[starts + counts // 2]) / 2
+    median[counts == 0] = np.nan
+    return median.tolist(), mean.tolist(), counts.tolist()
+
+
+def _group_reduce(vals: np.ndarray, order: np.ndarray, bounds: np.ndarray, func) -> list:
+    """ Apply func to non-NaN values of every gpu group, None for empty groups """
+    vals = vals[order]
+    result = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        group = vals[start:end]
+        group = group[~np.isnan(group)]
+        result.append(func(group) if group.size else None)
+    return result
+
+
+def _round(x, digits=4):
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return [_round(v, digits) for v in x]
+    if x is None or np.isnan(x):
+        return None
+    return round(float(x), digits)
+
+
+def get_fleet_stats(conn: sqlite3.Connection, from_ts: int, to_ts: int) -> bytes:
+    """
+    Market aggregates over all machines between from_ts and to_ts:
+      price       - median dph_base per GPU of every gpu_name for each day
+      occupancy   - rented GPUs / total GPUs of every gpu_name for each day
+      machines    - number of machines with known price for each day
+      reliability - quantiles of the latest reliability of every gpu_name
+                    and histogram over all machines
+    Step series are forward filled per machine and bucketed by round_day().
+    GPU model and count come from the latest hardware_ts row of each machine.
+    :return: json bytes
+    """
+    start = time()
+
+    hw = read_latest(conn, latest_query('hardware_ts', ['machine_id', 'timestamp', 'gpu_name', 'num_gpus'],
+                                        f"timestamp <= {to_ts}"), machine_key)
+    if hw is None:
+        return json.dumps({'days': [], 'gpu_names': []}).encode('utf-8')
+
+    hw = hw.sort_values('machine_id')
+    machine_ids = hw.machine_id.values
+    num_gpus = hw.num_gpus.values.astype(float)
+    num_gpus[num_gpus == 0] = np.nan
+
+    # sort machines by gpu model to reduce each group as a slice,
+    # machines without gpu_name get a group of their own instead of code -1
+    codes, gpu_names = pd.factorize(hw.gpu_name.fillna(const.FLEET_UNKNOWN_GPU))
+    order = np.argsort(codes, kind='stable')
+    bounds = np.append(np_group_slices(codes[order]), codes.size)
+    logging.debug(f"[FLEET] hardware of {machine_ids.size} machines {time_ms(time() - start)}ms")
+
+    days = round_day(pd.Series([from_ts, to_ts]))
+    days = np.arange(days[0], days[1] + 1, DAY)
+
+    price, machines = [], []
+    for cost in iter_daily_state(conn, 'cost_ts', 'dph_base', machine_ids, days, from_ts, to_ts):
+        median, _, count = _group_stats(cost / num_gpus, order, bounds)
+        price.append(median)
+        machines.append(count)
+    logging.debug(f"[FLEET] price {time_ms(time() - start)}ms")
+
+    occupancy = []
+    for rented in iter_daily_state(conn, 'rent_ts', 'num_gpus_rented', machine_ids, days, from_ts, to_ts):
+        occupancy.append(_group_stats(rented / num_gpus, order, bounds)[1])
+    logging.debug(f"[FLEET] occupancy {time_ms(time() - start)}ms")
+
+    rel = read_latest(conn, latest_query('reliability_ts', ['machine_id', 'timestamp', 'reliability'],
+                                         f"timestamp > {to_ts - const.FLEET_RELIABILITY_DAYS * DAY} "
+                                         f"AND timestamp <= {to_ts}"), machine_key)
+    reliability = np.full(machine_ids.size, np.nan)
+    _update_state(reliability, machine_ids, rel, 'reliability')
+    known = reliability[~np.isnan(reliability)]
+    counts, edges = np.histogram(known, bins=const.FLEET_RELIABILITY_BINS) if known.size else ([], [])
+    logging.debug(f"[FLEET] reliability {time_ms(time() - start)}ms")
+
+    # transpose day lists into {gpu_name: [value per day]}
+    result = {
+        'days': days.tolist(),
+        'gpu_names': list(gpu_names),
+        'price': {name: _round([day[i] for day in price]) for i, name in enumerate(gpu_names)},
+        'occupancy': {name: _round([day[i] for day in occupancy]) for i, name in enumerate(gpu_names)},
+        'machines': {name: [day[i] or 0 for day in machines] for i, name in enumerate(gpu_names)},
+        'reliability': {
+            'quantiles': const.FLEET_QUANTILES,
+            'by_gpu': dict(zip(gpu_names, _group_reduce(reliability, order, bounds,
+                                                        lambda x: _round(np.percentile(x, const.FLEET_QUANTILES))))),
+            'histogram': {'edges': _round(list(edges)), 'counts': list(map(int, counts))},
+        },
+    }
+    logging.debug(f"[FLEET] {days.size} days, {len(gpu_names)} gpu models {time_ms(time() - start)}ms")
+    return json.dumps(result).encode('utf-8')
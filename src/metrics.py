@@ -0,0 +1,284 @@
+"""
+Request pipeline metrics in Prometheus text exposition format, see
+https://prometheus.io/docs/instrumenting/exposition_formats/
+
+Metrics are process-wide objects registered in REGISTRY on creation.
+Observing a value takes a lock and a bisect over bucket bounds, so it is
+cheap enough for every table of every request.
+
+With several server processes (--workers) every process saves its values
+into a directory shared by all of them, and /metrics served by any of
+them sums values of all processes, see Registry.share(). Counters of a
+restarted worker start from zero again, so the sums drop like after a
+restart of the whole server, which Prometheus treats as counter reset.
+"""
+from __future__ import annotations
+
+import os
+import json
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# seconds, from a single indexed lookup to a full scan of large table
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# bytes, from empty table to multi-year history
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.shared_dir = None
+        self.worker = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, func):
+        """ func() updates metrics copied from elsewhere (cache, admission), called before values are read """
+        self.collectors.append(func)
+
+    def collect(self) -> list:
+        for func in self.collectors:
+            func()
+        with self._lock:
+            return list(self.metrics)
+
+    def share(self, shared_dir: str, worker: int, interval: float = 5):
+        """
+        Save values of this process as `worker` into shared_dir every
+        `interval` seconds and on every render(), render() sums values of
+        all workers found there. Saving before reading keeps every sum
+        monotonic: files of other workers are at least as new as when any
+        earlier render() read or wrote them.
+        """
+        self.shared_dir = shared_dir
+        self.worker = worker
+        self._stop.clear()
+        threading.Thread(target=self._run_saver, args=(interval,), name='metrics', daemon=True).start()
+
+    def _run_saver(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.save()
+            except Exception as e:
+                logging.error(f"[METRICS] Saving failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    def save(self):
+        state = {metric.name: metric.state() for metric in self.collect()}
+        path = os.path.join(self.shared_dir, f'worker-{self.worker}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def load_shared(self) -> list:
+        """ Saved states of all workers """
+        states = []
+        for name in sorted(os.listdir(self.shared_dir)):
+            if name.startswith('worker-') and name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.shared_dir, name)) as f:
+                        states.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    logging.warning(f"[METRICS] Unable to read {name}: {e}")
+        return states
+
+    def render(self) -> bytes:
+        metrics = self.collect()
+        states = None
+        if self.shared_dir:
+            self.save()
+            states = self.load_shared()
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            if states is None:
+                lines.extend(metric.samples())
+            else:
+                lines.extend(metric.samples(metric.merge([state.get(metric.name, []) for state in states])))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def state(self) -> list:
+        """ [[label values], value] pairs, json serializable """
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, states: list) -> dict:
+        """ Values of several processes summed by labels """
+        values = {}
+        for state in states:
+            for key, value in state:
+                key = tuple(key)
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def samples(self, values: dict = None) -> list:
+        """ :param values: {labels: value} to render instead of values of this process """
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        items = sorted(values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, value: float, **labels):
+        """ Copy of a counter maintained elsewhere, i.e. by LRUCache """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """ Count of code blocks currently running """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = TIME_BUCKETS,
+                 registry: Registry = REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, help, labels, registry)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per bucket counts (not cumulative), sum
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts[0][idx] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def state(self) -> list:
+        with self._lock:
+            return [[list(key), [list(counts), total]] for key, (counts, total) in self._values.items()]
+
+    def merge(self, states: list) -> dict:
+        values = {}
+        for state in states:
+            for key, (counts, total) in state:
+                key = tuple(key)
+                merged = values.get(key)
+                if merged is None:
+                    values[key] = [list(counts), total]
+                else:
+                    merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                    merged[1] += total
+        return values
+
+    def samples(self, values: dict = None) -> list:
+        if values is None:
+            with self._lock:
+                values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        items = sorted(values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _format_labels(self.labels, key, f'le="{_format_value(float(bound))}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram('vast_request_duration_seconds', 'End-to-end request latency', ('endpoint',))
+REQUESTS = Counter('vast_requests_total', 'Responses sent', ('endpoint', 'code'))
+IN_FLIGHT = Gauge('vast_requests_in_flight', 'Requests being served', ('endpoint',))
+QUERY_SECONDS = Histogram('vast_query_duration_seconds', 'SQL query and fetch time per table', ('table',))
+SERIALIZE_SECONDS = Histogram('vast_serialize_duration_seconds', 'Serialization time per response', ('format',))
+COMPRESS_SECONDS = Histogram('vast_compress_duration_seconds', 'Gzip time per response')
+RESPONSE_BYTES = Histogram('vast_response_bytes', 'Response body size sent', ('endpoint',), buckets=SIZE_BUCKETS)
+CACHE_ENTRIES = Gauge('vast_cache_entries', 'Responses in cache')
+CACHE_BYTES = Gauge('vast_cache_bytes', 'Size of cached responses')
+CACHE_LOOKUPS = Counter('vast_cache_lookups_total', 'Cache lookups', ('result',))
+COALESCED = Counter('vast_requests_coalesced_total', 'Responses computed by a concurrent identical request',
+                    ('endpoint',))
+ADMISSION_ACTIVE = Gauge('vast_admission_active', 'Computations holding an admission slot')
+REJECTED = Counter('vast_connections_rejected_total', 'Connections answered with 503 without a free thread')
+ADMISSION_WAITING = Gauge('vast_admission_waiting', 'Computations waiting for an admission slot')
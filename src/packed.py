@@ -0,0 +1,90 @@
+"""
+Packed binary encoding of /stats tables, served when the client sends
+`Accept: application/vnd.vast-stats.columns`.
+
+Layout, all integers little-endian:
+
+    magic    4 bytes   b'VST1'
+    hlen     uint32    length of json header in bytes
+    header   hlen      utf-8 json, padded with spaces so data starts 8-byte aligned
+    data               column buffers, each one starts at 8-byte aligned offset
+
+Header describes every table:
+
+    {"tables": {"rent_ts": {"length": 115,
+                            "columns": {"timestamp": {"dtype": "f8", "offset": 512}, ...},
+                            "values": {"gpu_name": ["RTX 4090", ...], ...}}, ...}}
+
+`offset` is counted from the start of data section (8 + hlen), so buffers
+map directly to typed arrays: f8 -> Float64Array, f4 -> Float32Array,
+i4 -> Int32Array.
+Timestamps are sent as f8 (exact for unix seconds) since uPlot can't use
+BigInt64Array. Integer columns fitting int32 go as i4, float columns as f4
+when float32 keeps the values exact, otherwise as f8. Non-numeric columns
+are sent in the json header as plain lists in "values".
+"""
+from __future__ import annotations
+
+import json
+import struct
+import numpy as np
+
+from src.utils import LazyModule
+
+pd = LazyModule('pandas')
+
+MAGIC = b'VST1'
+ALIGN = 8
+
+
+def _column_dtype(col: str, vals: np.ndarray) -> str | None:
+    if col == 'timestamp':
+        return '<f8'
+    if vals.dtype.kind in 'iub':
+        if vals.size == 0 or (vals.min() >= np.iinfo(np.int32).min and vals.max() <= np.iinfo(np.int32).max):
+            return '<i4'
+        return '<f8'
+    if vals.dtype.kind == 'f':
+        f32 = vals.astype('<f4')
+        if np.array_equal(f32, vals, equal_nan=True):
+            return '<f4'
+        return '<f8'
+    return None
+
+
+def _padding(size: int) -> int:
+    return -size % ALIGN
+
+
+def pack_tables(tables: dict[str, pd.DataFrame]) -> list:
+    """
+    Pack dataframes into binary message.
+    Numeric columns are passed as buffers without copying when their dtype
+    already matches the wire dtype.
+    :return: list of bytes-like parts, concatenated they form the message
+    """
+    header = {}
+    buffers = []
+    offset = 0
+    for tbl_name, df in tables.items():
+        columns = {}
+        values = {}
+        for col in df.columns:
+            vals = df[col].values
+            dtype = _column_dtype(col, vals)
+            if dtype is None:
+                values[col] = df[col].tolist()
+                continue
+            arr = np.ascontiguousarray(vals, dtype=dtype)
+            columns[col] = {'dtype': dtype[1:], 'offset': offset}
+            buffers.append(memoryview(arr).cast('B'))
+            offset += arr.nbytes
+            pad = _padding(arr.nbytes)
+            if pad:
+                buffers.append(b'\0' * pad)
+                offset += pad
+        header[tbl_name] = {'length': len(df), 'columns': columns, 'values': values}
+
+    header = json.dumps({'tables': header}).encode('utf-8')
+    header += b' ' * _padding(len(MAGIC) + 4 + len(header))
+    return [MAGIC + struct.pack('<I', len(header)), header] + buffers
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import os
+import signal
+import logging
+from time import time, sleep
+
+from src import const
+from src.utils import get_error_info
+
+
+class Supervisor:
+    """
+    Pre-fork process manager. Workers are forked after the listening socket
+    is bound, so all of them accept connections from the same socket and
+    the kernel hands every connection to one of them.
+
+    Workers exiting unexpectedly are restarted, with growing delay when
+    they keep crashing right after start. SIGTERM (or SIGINT) is forwarded
+    to all workers, they stop accepting and finish in-flight requests;
+    workers still running after const.WORKER_DRAIN_TIMEOUT are killed.
+    """
+    def __init__(self, n_workers: int, run_worker):
+        """
+        :param run_worker: function(worker_idx) run in forked process, its return value is the exit code
+        """
+        self.n_workers = n_workers
+        self.run_worker = run_worker
+        self.workers = {}           # pid: worker_idx
+        self._started = {}          # worker_idx: start time
+        self._delays = {}           # worker_idx: restart delay
+        self._pending = {}          # worker_idx: time to restart at
+        self._stopping = False
+        self._deadline = None
+
+    def spawn(self, idx: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                code = self.run_worker(idx) or 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException as e:
+                logging.error(f"[PREFORK] Worker {idx} failed: {get_error_info(e)}")
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        self.workers[pid] = idx
+        self._started[idx] = time()
+        logging.info(f"[PREFORK] Worker {idx} started, pid {pid}")
+
+    def stop(self, signum, frame):
+        if self._stopping:
+            return
+        logging.warning(f"[PREFORK] Signal {signum}, stopping {len(self.workers)} workers ...")
+        self._stopping = True
+        self._pending.clear()
+        self._deadline = time() + const.WORKER_DRAIN_TIMEOUT
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self):
+        """ Collect exited workers, schedule restart of crashed ones """
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            idx = self.workers.pop(pid, None)
+            if idx is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if self._stopping:
+                logging.info(f"[PREFORK] Worker {idx} (pid {pid}) exited with {code}")
+                continue
+
+            uptime = time() - self._started[idx]
+            if uptime < const.WORKER_MIN_UPTIME:
+                delay = min(self._delays.get(idx, const.WORKER_RESTART_DELAY / 2) * 2, const.WORKER_MAX_RESTART_DELAY)
+            else:
+                delay = const.WORKER_RESTART_DELAY
+            self._delays[idx] = delay
+            self._pending[idx] = time() + delay
+            logging.error(f"[PREFORK] Worker {idx} (pid {pid}) exited with {code} after {uptime:.0f}s, "
+                          f"restarting in {delay:.0f}s")
+
+    def run(self) -> int:
+        """ Start workers and supervise them until all are stopped """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for idx in range(self.n_workers):
+            self.spawn(idx)
+
+        while self.workers or self._pending:
+            self._reap()
+            now = time()
+            for idx, at in list(self._pending.items()):
+                if at <= now:
+                    del self._pending[idx]
+                    self.spawn(idx)
+
+            if self._stopping and self._deadline < now:
+                for pid, idx in self.workers.items():
+                    logging.error(f"[PREFORK] Worker {idx} (pid {pid}) did not stop in time, killing")
+                    os.kill(pid, signal.SIGKILL)
+                self._deadline = float('inf')
+            sleep(const.WORKER_POLL_INTERVAL)
+
+        logging.info("[PREFORK] All workers stopped")
+        return 0
@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+from time import time
+
+import numpy as np
+
+from src import const
+from src import schema
+from src.utils import LazyModule, time_ms, get_error_info, np_group_slices, ts_utc_now
+
+pd = LazyModule('pandas')
+
+ATTACH_NAME = 'rollup'
+
+
+def rollup_table(tbl_name: str, tier: str) -> str:
+    return f"{tbl_name}_{tier}"
+
+
+def _is_numeric(decl_type: str) -> bool:
+    decl_type = decl_type.upper()
+    return any(t in decl_type for t in ('INT', 'REAL', 'FLOA', 'DOUB', 'NUM'))
+
+
+def aggregate(df: pd.DataFrame, period: int, value_cols: list, numeric_cols: list) -> dict:
+    """
+    Aggregate rows sorted by machine_id, timestamp into buckets of `period`
+    seconds: min, max and last value of numeric columns, last value of others.
+    :return: {column: array} of rollup rows
+    """
+    machine_ids = df.machine_id.values.astype(np.int64)
+    ts = df.timestamp.values.astype(np.int64)
+    buckets = ts // period
+
+    slice_idx = np_group_slices((machine_ids << 32) | buckets)
+    last_idx = np.append(slice_idx[1:], len(df)) - 1
+
+    result = {
+        'machine_id': machine_ids[slice_idx],
+        'timestamp': buckets[slice_idx] * period,
+    }
+    for col in value_cols:
+        vals = df[col].values
+        result[col] = vals[last_idx]
+        if col in numeric_cols:
+            vals = vals.astype(float)
+            result[f'{col}_min'] = np.fmin.reduceat(vals, slice_idx)
+            result[f'{col}_max'] = np.fmax.reduceat(vals, slice_idx)
+    result['last_timestamp'] = ts[last_idx]
+    return result
+
+
+class Rollup:
+    """
+    Hourly and daily rollups of *_ts tables, kept in a separate database
+    next to the collector's one. Every rollup row holds min, max and last
+    value of each column within the bucket, keyed by machine_id and bucket
+    start timestamp.
+
+    Rollups are updated incrementally: only raw rows newer than the
+    high-water mark timestamp of each table are read, and merged into
+    existing buckets with upsert. Readers attach the rollup database to
+    their connections as `rollup` and pick resolution with select_tier().
+
+    Generation is kept in PRAGMA user_version of the rollup database, so
+    with several server processes one of them updates rollups and the
+    others only follow its metadata (start(update=False)).
+    """
+    def __init__(self, db_path: str, rollup_path: str, tables: list = None):
+        self.db_path = db_path
+        self.rollup_path = rollup_path
+        self.tables = tables or const.TS_TABLES
+        self.generation = 0
+        self._meta = {}
+        self._columns = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect_raw(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.rollup_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def init_schema(self):
+        raw = self._connect_raw()
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS rollup_meta "
+                         "(tbl_name TEXT PRIMARY KEY, hwm INTEGER, first_ts INTEGER, last_ts INTEGER)")
+            for tbl_name in self.tables:
+                info = raw.execute(f"PRAGMA table_info({tbl_name})").fetchall()
+                types = {row[1]: row[2] for row in info}
+                value_cols = [col for col in types if col not in schema.INDEX_KEY]
+                numeric_cols = [col for col in value_cols if _is_numeric(types[col])]
+                self._columns[tbl_name] = (value_cols, numeric_cols)
+
+                cols = [f"{col} {types[col]}" for col in value_cols]
+                cols += [f"{col}_{agg} REAL" for col in numeric_cols for agg in ('min', 'max')]
+                for tier in const.ROLLUP_TIERS:
+                    conn.execute(f"CREATE TABLE IF NOT EXISTS {rollup_table(tbl_name, tier)} "
+                                 f"(machine_id INTEGER, timestamp INTEGER, {', '.join(cols)}, last_timestamp INTEGER, "
+                                 f"PRIMARY KEY (machine_id, timestamp)) WITHOUT ROWID")
+            conn.commit()
+            self._load_meta(conn)
+        finally:
+            raw.close()
+            conn.close()
+
+    def _load_meta(self, conn: sqlite3.Connection):
+        rows = conn.execute("SELECT tbl_name, hwm, first_ts, last_ts FROM rollup_meta").fetchall()
+        self._meta = {row[0]: row[1:] for row in rows}
+        self.generation = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def refresh(self):
+        """ Reload metadata written by the process running updates """
+        conn = sqlite3.connect(f"file:{self.rollup_path}?mode=ro", uri=True)
+        try:
+            self._load_meta(conn)
+        finally:
+            conn.close()
+
+    @property
+    def ready(self) -> bool:
+        """ All tables have been rolled up at least once """
+        return all(tbl_name in self._meta for tbl_name in self.tables)
+
+    def _upsert_sql(self, tbl_name: str, tier: str, columns: list) -> str:
+        value_cols, numeric_cols = self._columns[tbl_name]
+        updates = []
+        for col in value_cols:
+            updates.append(f"{col} = CASE WHEN excluded.last_timestamp >= last_timestamp "
+                           f"THEN excluded.{col} ELSE {col} END")
+        for col in numeric_cols:
+            updates.append(f"{col}_min = min(coalesce({col}_min, excluded.{col}_min), "
+                           f"coalesce(excluded.{col}_min, {col}_min))")
+            updates.append(f"{col}_max = max(coalesce({col}_max, excluded.{col}_max), "
+                           f"coalesce(excluded.{col}_max, {col}_max))")
+        updates.append("last_timestamp = max(last_timestamp, excluded.last_timestamp)")
+        return (f"INSERT INTO {rollup_table(tbl_name, tier)} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (machine_id, timestamp) DO UPDATE SET {', '.join(updates)}")
+
+    def update_table(self, raw: sqlite3.Connection, conn: sqlite3.Connection, tbl_name: str, upper: int) -> int:
+        """
+        Merge raw rows with hwm < timestamp <= upper into both tiers.
+        Merging is idempotent, so chunks are committed one by one and the
+        high-water mark moves only when the whole range is done.
+        :return: number of raw rows processed
+        """
+        hwm, first_ts, last_ts = self._meta.get(tbl_name, (0, None, None))
+        value_cols, numeric_cols = self._columns[tbl_name]
+        # range of every machine is an index seek, rows older than hwm are never read
+        sql_query = (f"{schema.machine_ids_cte(tbl_name)}"
+                     f"SELECT t.* FROM ids CROSS JOIN {tbl_name} t ON t.machine_id = ids.machine_id "
+                     f"WHERE t.timestamp > {hwm} AND t.timestamp <= {upper} "
+                     f"ORDER BY t.machine_id, t.timestamp")
+
+        n_rows = 0
+        for chunk in pd.read_sql(sql_query, raw, chunksize=const.ROLLUP_CHUNK_ROWS):
+            if chunk.empty:
+                continue
+            n_rows += len(chunk)
+            chunk_first, chunk_last = int(chunk.timestamp.min()), int(chunk.timestamp.max())
+            first_ts = chunk_first if first_ts is None else min(first_ts, chunk_first)
+            last_ts = chunk_last if last_ts is None else max(last_ts, chunk_last)
+            for tier, period in const.ROLLUP_TIERS.items():
+                rows = aggregate(chunk, period, value_cols, numeric_cols)
+                columns = list(rows)
+                conn.executemany(self._upsert_sql(tbl_name, tier, columns),
+                                 zip(*[rows[col].tolist() for col in columns]))
+            conn.commit()
+
+        conn.execute("INSERT OR REPLACE INTO rollup_meta VALUES (?, ?, ?, ?)", (tbl_name, upper, first_ts, last_ts))
+        conn.commit()
+        return n_rows
+
+    def update(self) -> int:
+        """
+        Roll up new raw rows of every table. Rows of the last ROLLUP_LAG
+        seconds are left for the next update, so rows committed late by
+        the collector are not skipped.
+        """
+        start = time()
+        upper = ts_utc_now() - const.ROLLUP_LAG
+        raw = self._connect_raw()
+        conn = self._connect()
+        n_rows = 0
+        try:
+            for tbl_name in self.tables:
+                n_rows += self.update_table(raw, conn, tbl_name, upper)
+            if n_rows:
+                conn.execute(f"PRAGMA user_version = {self.generation + 1}")
+            self._load_meta(conn)
+        finally:
+            raw.close()
+            conn.close()
+
+        logging.info(f"[ROLLUP] {n_rows} rows rolled up {time_ms(time() - start)}ms")
+        return n_rows
+
+    def high_water_mark(self, tbl_name: str) -> int | None:
+        """ Raw rows up to this timestamp are rolled up """
+        meta = self._meta.get(tbl_name)
+        return meta[0] if meta else None
+
+    def select_tier(self, tbl_name: str, from_ts=None, to_ts=None, resolution: str = 'auto') -> str | None:
+        """
+        Resolution to serve a request with: None for raw table or tier name.
+        'auto' picks the coarsest resolution still having enough points
+        for requested time span (const.ROLLUP_SPANS).
+        Tiers lack raw rows after high_water_mark(), i.e. the last
+        ROLLUP_INTERVAL + ROLLUP_LAG seconds at most, responses served
+        from them say so in X-Rollup-Until header.
+        """
+        if resolution == 'raw' or not self.ready:
+            return None
+        if resolution != 'auto':
+            return resolution
+
+        _, first_ts, last_ts = self._meta[tbl_name]
+        start = max(from_ts or 0, first_ts or 0)
+        end = min(to_ts or last_ts or 0, last_ts or 0)
+        span = end - start
+        for tier, max_span in const.ROLLUP_SPANS.items():
+            if span <= max_span:
+                return None if tier == 'raw' else tier
+        return list(const.ROLLUP_TIERS)[-1]
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.update()
+            except Exception as e:
+                logging.error(f"[ROLLUP] Update failed: {get_error_info(e)}")
+            self._stop.wait(const.ROLLUP_INTERVAL)
+
+    def follow(self):
+        while not self._stop.wait(const.ROLLUP_REFRESH_INTERVAL):
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"[ROLLUP] Refresh failed: {get_error_info(e)}")
+
+    def start(self, update: bool = True):
+        """ :param update: run updates, otherwise only follow metadata of rollup database """
+        if update:
+            self.init_schema()
+        else:
+            self.refresh()
+        self._thread = threading.Thread(target=self.run if update else self.follow, name='rollup', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
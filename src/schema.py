@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import re
+import sqlite3
+import logging
+from time import time
+
+from src.utils import time_ms
+
+# leading columns of the index every /stats query needs
+INDEX_KEY = ['machine_id', 'timestamp']
+
+# tables with at most this many columns get covering index (key + all columns),
+# so SELECT * is answered from the index without touching the table
+COVERING_MAX_COLUMNS = 4
+
+
+def table_columns(conn: sqlite3.Connection, tbl_name: str) -> list:
+    """ tbl_name can be prefixed by attached database name: 'rollup.rent_ts_hour' """
+    db_name, _, tbl_name = tbl_name.rpartition('.')
+    pragma = f"PRAGMA {db_name}.table_info" if db_name else "PRAGMA table_info"
+    return [row[1] for row in conn.execute(f"{pragma}({tbl_name})")]
+
+
+class Registry:
+    """
+    Columns of the served tables, read from database once. Field names of
+    requests are checked against it, so only existing column names ever
+    get into sql.
+    """
+    def __init__(self, conn: sqlite3.Connection, tables: list, profiles: dict = None):
+        self.columns = {tbl_name: table_columns(conn, tbl_name) for tbl_name in tables}
+        self.profiles = profiles or {}
+
+    def resolve(self, spec: str) -> dict | None:
+        """
+        Parse fields spec: comma separated profile names, `table` or `table.column` items.
+        Columns keep table order, timestamp is added to tables having it.
+        :return: {tbl_name: [columns]} of tables to project, None for all columns of all tables
+        :raises ValueError: unknown profile, table or column
+        """
+        fields = {}
+        for item in [item.strip() for item in spec.split(',') if item.strip()]:
+            if item in self.profiles:
+                for tbl_name, columns in self.profiles[item].items():
+                    fields.setdefault(tbl_name, set()).update(columns)
+                continue
+
+            tbl_name, _, col = item.partition('.')
+            if tbl_name not in self.columns:
+                raise ValueError(f"unknown field '{item}'")
+            if not col:
+                fields.setdefault(tbl_name, set()).update(self.columns[tbl_name])
+            elif col in self.columns[tbl_name]:
+                fields.setdefault(tbl_name, set()).add(col)
+            else:
+                raise ValueError(f"unknown column '{col}' of {tbl_name}")
+
+        result = {}
+        for tbl_name, selected in fields.items():
+            # profile may list columns a particular database doesn't have
+            columns = [col for col in self.columns[tbl_name] if col in selected or col == 'timestamp']
+            if columns != self.columns[tbl_name]:
+                result[tbl_name] = columns
+        return result or None
+
+
+def index_columns(conn: sqlite3.Connection, tbl_name: str) -> dict:
+    """
+    :return: {index_name: [columns]} for every index of the table, including
+             primary key of WITHOUT ROWID tables
+    """
+    result = {}
+    for row in conn.execute(f"PRAGMA index_list({tbl_name})").fetchall():
+        idx_name = row[1]
+        info = conn.execute(f"PRAGMA index_info('{idx_name}')").fetchall()
+        result[idx_name] = [col[2] for col in sorted(info)]
+    return result
+
+
+def index_key(columns: list) -> list:
+    return [col for col in INDEX_KEY if col in columns]
+
+
+def has_index(conn: sqlite3.Connection, tbl_name: str, key: list) -> bool:
+    return any(cols[:len(key)] == key for cols in index_columns(conn, tbl_name).values())
+
+
+def machine_ids_cte(tbl_name: str) -> str:
+    """
+    WITH clause of table `ids` holding distinct machine_id of the table.
+    Every step seeks the (machine_id, timestamp) index to the next machine,
+    so queries joining it on machine_id read only rows of their time range
+    instead of scanning the whole index.
+    """
+    return (f"WITH RECURSIVE ids(machine_id) AS (SELECT min(machine_id) FROM {tbl_name} UNION ALL "
+            f"SELECT (SELECT min(machine_id) FROM {tbl_name} WHERE machine_id > ids.machine_id) "
+            f"FROM ids WHERE machine_id IS NOT NULL) ")
+
+
+def ensure_indexes(db_path: str, tables: list, covering: dict = None) -> list:
+    """
+    Create (machine_id, timestamp) index on every table missing one.
+    :param covering: {tbl_name: [columns]} usually requested, included in index of
+                     wider tables when it stays within COVERING_MAX_COLUMNS
+    :return: list of created index names
+    """
+    created = []
+    conn = sqlite3.connect(db_path)
+    try:
+        for tbl_name in tables:
+            columns = table_columns(conn, tbl_name)
+            key = index_key(columns)
+            if not key or has_index(conn, tbl_name, key):
+                continue
+
+            idx_cols = key
+            if len(columns) <= COVERING_MAX_COLUMNS:
+                idx_cols = key + [col for col in columns if col not in key]
+            elif covering and tbl_name in covering:
+                extra = [col for col in columns if col in covering[tbl_name] and col not in key]
+                if len(key + extra) <= COVERING_MAX_COLUMNS:
+                    idx_cols = key + extra
+            idx_name = f"{tbl_name}_{'_'.join(key)}_idx"
+
+            start = time()
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON {tbl_name} ({', '.join(idx_cols)})")
+            conn.commit()
+            created.append(idx_name)
+            logging.info(f"[SCHEMA] Created index {idx_name} ({', '.join(idx_cols)}) {time_ms(time() - start)}ms")
+    except sqlite3.OperationalError as e:
+        logging.warning(f"[SCHEMA] Unable to create indexes in {db_path}: {e}")
+    finally:
+        conn.close()
+    return created
+
+
+def query_scans(conn: sqlite3.Connection, sql_query: str, tables: list) -> list:
+    """
+    EXPLAIN QUERY PLAN of the query.
+    :return: plan lines doing full scan of any of the tables
+    """
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql_query}").fetchall()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        match = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+        if match and match.group(1) in tables:
+            scans.append(detail)
+    return scans
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import http.server
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src import const
+from src import metrics
+
+OVERLOADED_RESPONSE = (f"HTTP/1.0 503 Service Unavailable\r\nRetry-After: {const.RETRY_AFTER}\r\n"
+                       f"Content-Length: 0\r\nConnection: close\r\n\r\n").encode('ascii')
+
+
+class ThreadPoolHTTPServer(http.server.HTTPServer):
+    """
+    HTTP server handling each connection in a bounded pool of worker threads.
+    At most max_threads requests are processed concurrently, at most
+    max_pending more wait in the executor queue. Connections beyond that
+    are answered with 503 and Retry-After right away, like requests
+    rejected by Admission, instead of queueing without limit.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, max_threads: int = const.MAX_THREADS, max_pending: int = None):
+        """ :param max_pending: connections waiting for a thread, max_threads * const.PENDING_SHARE by default """
+        super().__init__(server_address, handler_class)
+        self.max_threads = max_threads
+        self.max_pending = max_pending if max_pending is not None else int(max_threads * const.PENDING_SHARE)
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='worker')
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        logging.debug(f"Thread pool started with {max_threads} workers, {self.max_pending} pending connections")
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            accepted = self._in_flight < self.max_threads + self.max_pending
+            if accepted:
+                self._in_flight += 1
+        if not accepted:
+            self.reject_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def reject_request(self, request):
+        """ 503 written by the accepting thread, without reading the request """
+        metrics.REJECTED.inc()
+        try:
+            request.sendall(OVERLOADED_RESPONSE)
+            # closing with unread request data resets the connection, client could lose the response
+            request.setblocking(False)
+            request.recv(65536)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                self._in_flight -= 1
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+from time import time
+
+import numpy as np
+
+from src import const
+from src.utils import time_ms, get_error_info
+
+
+def to_array(values: tuple) -> np.ndarray:
+    """
+    Column read from SQLite with the dtypes pandas would give it: integers,
+    floats with NaN for NULLs of numeric columns, objects otherwise.
+    Integers are shrunk to the smallest type holding them, equal strings
+    share one object.
+    """
+    types = {type(v) for v in values}
+    if types <= {int}:
+        arr = np.array(values, dtype=np.int64)
+        if arr.size:
+            arr = arr.astype(np.result_type(np.min_scalar_type(arr.min()), np.min_scalar_type(arr.max())))
+        return arr
+    if types <= {int, float, type(None)}:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    shared = {}
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = [shared.setdefault(v, v) for v in values]
+    return arr
+
+
+def columns_to_json(data: dict, fmt: str = 'records') -> str:
+    """ Json of {col: array} in the layout of df_to_json(), NaN as null """
+    values = {}
+    for col, arr in data.items():
+        vals = arr.tolist()
+        values[col] = [None if v != v else v for v in vals] if arr.dtype.kind == 'f' else vals
+    if fmt == 'columns':
+        return '{' + ','.join([f'{json.dumps(col)}: {json.dumps(vals, separators=(",", ":"))}'
+                               for col, vals in values.items()]) + '}'
+    return json.dumps([dict(zip(values, row)) for row in zip(*values.values())], separators=(',', ':'))
+
+
+class Snapshot:
+    """ Columns of one table sorted by machine_id, with the sorted ids as lookup index """
+    def __init__(self, columns: dict):
+        # lexsort sorts by the last key first
+        keys = [columns[col] for col in ['timestamp', 'machine_id'] if col in columns]
+        order = np.lexsort(keys)
+        self.columns = {col: arr[order] for col, arr in columns.items()}
+        self.machine_ids = self.columns['machine_id']
+
+    def rows(self, machine_id) -> slice | np.ndarray:
+        """ Row positions of single machine_id or list of them """
+        if not isinstance(machine_id, (list, tuple)):
+            lo = np.searchsorted(self.machine_ids, machine_id, side='left')
+            hi = np.searchsorted(self.machine_ids, machine_id, side='right')
+            return slice(lo, hi)
+        ids = np.asarray(machine_id)
+        if not len(ids):
+            return slice(0, 0)
+        lo = np.searchsorted(self.machine_ids, ids, side='left')
+        hi = np.searchsorted(self.machine_ids, ids, side='right')
+        return np.concatenate([np.arange(l, h) for l, h in zip(lo, hi)])
+
+    def get(self, machine_id, columns: list = None) -> dict:
+        rows = self.rows(machine_id)
+        return {col: self.columns[col][rows] for col in columns or self.columns}
+
+    def last_timestamp(self, machine_id):
+        """ Latest timestamp of the machine, None without rows or timestamp column """
+        timestamps = self.columns.get('timestamp')
+        if timestamps is None:
+            return None
+        rows = self.rows(machine_id)
+        return timestamps[rows.stop - 1].item() if rows.stop > rows.start else None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(arr.nbytes for arr in self.columns.values())
+
+
+class SnapshotStore:
+    """
+    Small, rarely changing tables (snapshots and machine_host_map) held in
+    memory, so /stats doesn't query them. Tables are reloaded in background
+    when PRAGMA data_version changes, new set of tables replaces the old one
+    in a single assignment, so readers always see a consistent set.
+    Tables are numpy columns, json of a machine is built without pandas.
+    """
+    def __init__(self, db_path: str, tables: list = None):
+        self.db_path = db_path
+        self.tables = tables or const.SNP_TABLES + ['machine_host_map']
+        self.version = None
+        self._snapshots = {}
+        self._machine_index = None
+        self._conn = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        return bool(self._snapshots)
+
+    def __contains__(self, tbl_name: str) -> bool:
+        return tbl_name in self._snapshots
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        return self._conn
+
+    @staticmethod
+    def _read(conn: sqlite3.Connection, tbl_name: str) -> dict:
+        cursor = conn.execute(f"SELECT * FROM {tbl_name}")
+        names = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        values = list(zip(*rows)) if rows else [()] * len(names)
+        return {name: to_array(vals) for name, vals in zip(names, values)}
+
+    def load(self) -> bool:
+        """ Reload all tables if database changed since the last load """
+        conn = self._connect()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.version:
+            return False
+
+        start = time()
+        snapshots = {tbl_name: Snapshot(self._read(conn, tbl_name)) for tbl_name in self.tables}
+
+        ids = np.unique(snapshots['machine_host_map'].machine_ids)
+        str_ids = ids.astype(str)
+        order = np.argsort(str_ids)
+        self._machine_index = (str_ids[order], ids[order])
+        self._snapshots = snapshots
+        self.version = version
+
+        size = sum(s.nbytes for s in snapshots.values())
+        logging.info(f"[SNAPSHOTS] Loaded {len(snapshots)} tables, {size / 1024:.0f}Kb {time_ms(time() - start)}ms")
+        return True
+
+    def get(self, tbl_name: str, machine_id, columns: list = None) -> dict:
+        """ {col: array} of single machine_id or list of them """
+        return self._snapshots[tbl_name].get(machine_id, columns)
+
+    def last_timestamps(self, machine_id: int) -> dict:
+        """ {tbl_name: latest timestamp of the machine} of loaded tables """
+        snapshots = self._snapshots
+        return {tbl_name: snapshot.last_timestamp(machine_id) for tbl_name, snapshot in snapshots.items()}
+
+    def to_json(self, tbl_name: str, machine_id, columns: list = None, fmt: str = 'records') -> str:
+        return columns_to_json(self.get(tbl_name, machine_id, columns), fmt)
+
+    def table(self, tbl_name: str) -> dict:
+        return self._snapshots[tbl_name].columns
+
+    def host_machines(self, host_id: int) -> list:
+        columns = self.table('machine_host_map')
+        return sorted(set(columns['machine_id'][columns['host_id'] == host_id].tolist()))
+
+    def find_machines(self, prefix: str, limit: int) -> list:
+        """
+        Machine ids starting with prefix, in string order.
+        Binary search over ids sorted as strings.
+        """
+        str_ids, ids = self._machine_index
+        lo = np.searchsorted(str_ids, prefix, side='left')
+        hi = np.searchsorted(str_ids, prefix + '\uffff', side='left')
+        return ids[lo:min(hi, lo + limit)].tolist()
+
+    def run(self):
+        while not self._stop.wait(const.SNAPSHOT_INTERVAL):
+            try:
+                self.load()
+            except Exception as e:
+                logging.error(f"[SNAPSHOTS] Reload failed: {get_error_info(e)}")
+
+    def start(self):
+        self.load()
+        self._thread = threading.Thread(target=self.run, name='snapshots', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._conn:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import os
+import re
+import gzip
+import hashlib
+import logging
+import mimetypes
+
+INDEX = 'index.html'
+# fingerprinted urls never change content, so they are cached by browsers for a year
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# local assets referenced from html, rewritten to fingerprinted urls
+ASSET_REF = re.compile(r'''((?:src|href)=["'])([\w./-]+\.(?:js|css))(["'])''')
+
+
+def make_etag(*parts) -> str:
+    return '"' + hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """ If-None-Match header contains etag, weak comparison as required for GET """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return etag.removeprefix('W/') in tags
+
+
+class Asset:
+    def __init__(self, data: bytes, gzipped: bytes | None, content_type: str, version: str):
+        self.data = data
+        self.gzipped = gzipped
+        self.content_type = content_type
+        self.version = version
+        self.etag = f'"{version}"'
+
+
+class StaticAssets:
+    """
+    Files of the static directory loaded into memory at startup, gzipped
+    once when it makes them smaller. References to local js/css in html
+    files are rewritten to `name?v=<version>`, so those urls can be cached
+    forever and a new deploy changes the url instead.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.assets = {}
+        self.load()
+
+    def _make_asset(self, data: bytes, content_type: str) -> Asset:
+        gzipped = None
+        if content_type.startswith(COMPRESSIBLE):
+            gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gzipped) >= len(data):
+                gzipped = None
+        version = hashlib.blake2b(data, digest_size=6).hexdigest()
+        return Asset(data, gzipped, content_type, version)
+
+    def load(self):
+        files = {}
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                full_path = os.path.join(root, name)
+                url = '/' + os.path.relpath(full_path, self.path).replace(os.sep, '/')
+                with open(full_path, 'rb') as f:
+                    files[url] = f.read()
+
+        def content_type(url):
+            mime = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+            return mime + '; charset=utf-8' if mime.startswith('text/') or mime.endswith('javascript') else mime
+
+        # html goes last, it references versions of the other assets
+        for url in sorted(files, key=lambda u: u.endswith('.html')):
+            data = files[url]
+            if url.endswith('.html'):
+                data = ASSET_REF.sub(self._fingerprint, data.decode('utf-8')).encode('utf-8')
+            self.assets[url] = self._make_asset(data, content_type(url))
+
+        size = sum(len(a.gzipped or a.data) for a in self.assets.values())
+        logging.info(f"[STATIC] Loaded {len(self.assets)} files from {self.path}, {size} bytes")
+
+    def _fingerprint(self, match: re.Match) -> str:
+        prefix, ref, suffix = match.groups()
+        asset = self.assets.get('/' + ref.removeprefix('./').removeprefix('/'))
+        if asset is None:
+            return match.group(0)
+        return f"{prefix}{ref}?v={asset.version}{suffix}"
+
+    def get(self, url_path: str) -> Asset | None:
+        if url_path.endswith('/'):
+            url_path += INDEX
+        return self.assets.get(url_path)
+
+    @staticmethod
+    def cache_control(asset: Asset, query_params: dict) -> str:
+        if query_params.get('v', [None])[0] == asset.version:
+            return IMMUTABLE
+        return REVALIDATE
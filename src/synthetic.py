@@ -0,0 +1,141 @@
+"""
+Synthetic vast.db with the schema of the collector, for benchmarks and
+local development:
+
+    python -m src.synthetic ./synthetic.db --machines 1000 --days 90
+
+Every machine gets one hardware row and snapshots, reliability every
+RELIABILITY_PERIOD seconds, daily averages and random rent/cost changes.
+Output only depends on arguments, the same seed gives the same database.
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sqlite3
+from time import time
+
+import numpy as np
+
+from src.utils import time_ms
+
+DAY = 24 * 3600
+RELIABILITY_PERIOD = 900
+RENT_CHANGES_PER_DAY = 2
+COST_CHANGES_PER_DAY = 0.5
+FIRST_MACHINE_ID = 1000
+MACHINES_PER_HOST = 4
+
+SCHEMA = {
+    'machine_host_map': 'machine_id INTEGER, host_id INTEGER, timestamp INTEGER',
+    'hardware_ts': 'machine_id INTEGER, timestamp INTEGER, cpu_name TEXT, cpu_cores INTEGER, mobo_name TEXT, '
+                   'num_gpus INTEGER, gpu_name TEXT, gpu_ram INTEGER, gpu_lanes INTEGER, pci_gen REAL, '
+                   'total_flops REAL, disk_name TEXT',
+    'cost_ts': 'machine_id INTEGER, timestamp INTEGER, dph_base INTEGER, storage_cost INTEGER, '
+               'inet_up_cost INTEGER, inet_down_cost INTEGER, min_bid INTEGER, credit_discount_max REAL',
+    'rent_ts': 'machine_id INTEGER, timestamp INTEGER, num_gpus_rented INTEGER',
+    'reliability_ts': 'machine_id INTEGER, timestamp INTEGER, reliability INTEGER',
+    'avg_ts': 'machine_id INTEGER, timestamp INTEGER, gpu_mem_bw_avg INTEGER, pcie_bw_avg INTEGER, '
+              'disk_bw_avg INTEGER, inet_up_avg INTEGER, inet_down_avg INTEGER',
+    'eod_snp': 'machine_id INTEGER, timestamp INTEGER, public_ipaddr TEXT, country TEXT, isp TEXT, '
+               'verification INTEGER, direct_port_count INTEGER',
+    'disk_snp': 'machine_id INTEGER, timestamp INTEGER, disk_space INTEGER',
+    'cpu_ram_snp': 'machine_id INTEGER, timestamp INTEGER, cpu_ram INTEGER',
+}
+
+# gpu_name, gpu_ram, flops per gpu, base price per gpu in 1/1000 $/h
+GPUS = [
+    ('RTX 4090', 24000, 82.6, 400),
+    ('RTX 3090', 24000, 35.6, 200),
+    ('A100 SXM4', 80000, 19.5, 1100),
+    ('RTX A6000', 48000, 38.7, 500),
+]
+COUNTRIES = ['US', 'DE', 'CA', 'PL', 'SE', 'JP']
+
+
+def _insert(conn: sqlite3.Connection, tbl_name: str, columns: list):
+    """ Insert rows given as list of equal length columns """
+    rows = zip(*[col.tolist() if isinstance(col, np.ndarray) else col for col in columns])
+    conn.executemany(f"INSERT INTO {tbl_name} VALUES ({', '.join('?' * len(columns))})", rows)
+
+
+def _changes(rng, ts: np.ndarray, per_day: float) -> np.ndarray:
+    """ Random sorted subset of ts, roughly per_day changes per day """
+    n = max(1, int(ts.size * per_day * RELIABILITY_PERIOD / DAY))
+    return np.sort(rng.choice(ts, min(n, ts.size), replace=False))
+
+
+def create_db(db_path: str, n_machines: int = 200, days: int = 60, seed: int = 0,
+              end_ts: int = 1_710_000_000) -> dict:
+    """
+    Create synthetic database, existing file is replaced.
+    :return: {tbl_name: number of rows}
+    """
+    start = time()
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    rng = np.random.default_rng(seed)
+    start_ts = end_ts - days * DAY
+    ts = np.arange(start_ts, end_ts, RELIABILITY_PERIOD)
+    day_ts = np.arange(start_ts, end_ts, DAY)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for tbl_name, columns in SCHEMA.items():
+        conn.execute(f"CREATE TABLE {tbl_name} ({columns})")
+
+    for machine_id in range(FIRST_MACHINE_ID, FIRST_MACHINE_ID + n_machines):
+        gpu_name, gpu_ram, flops, price = GPUS[machine_id % len(GPUS)]
+        num_gpus = int(rng.choice([1, 2, 4, 8]))
+        first_ts = int(start_ts + rng.integers(0, days // 4 + 1) * DAY)
+        m_ts = ts[ts >= first_ts]
+        m_day_ts = day_ts[day_ts >= first_ts]
+        one = [machine_id], [first_ts]
+
+        _insert(conn, 'machine_host_map', [[machine_id], [100 + machine_id // MACHINES_PER_HOST], [first_ts]])
+        _insert(conn, 'hardware_ts', [*one, ['AMD EPYC'], [32], ['ROMED8-2T'], [num_gpus], [gpu_name],
+                                      [gpu_ram], [16], [4.0], [round(flops * num_gpus, 1)], ['Samsung 980']])
+        _insert(conn, 'eod_snp', [*one, [f'10.0.{machine_id // 256 % 256}.{machine_id % 256}'],
+                                  [COUNTRIES[machine_id % len(COUNTRIES)]], ['ISP'], [1], [100]])
+        _insert(conn, 'disk_snp', [*one, [int(rng.integers(1, 8)) * 1000]])
+        _insert(conn, 'cpu_ram_snp', [*one, [num_gpus * 64]])
+
+        mids = np.full(m_ts.size, machine_id)
+        walk = rng.normal(0, 30, m_ts.size).cumsum() / 10
+        reliability = np.clip(9900 + walk, 8000, 10000).astype(int)
+        _insert(conn, 'reliability_ts', [mids, m_ts, reliability])
+
+        rent_ts = _changes(rng, m_ts, RENT_CHANGES_PER_DAY)
+        _insert(conn, 'rent_ts', [mids[:rent_ts.size], rent_ts, rng.integers(0, num_gpus + 1, rent_ts.size)])
+
+        cost_ts = _changes(rng, m_ts, COST_CHANGES_PER_DAY)
+        n = cost_ts.size
+        dph = (price * rng.uniform(0.7, 1.3, n)).astype(int) * num_gpus
+        _insert(conn, 'cost_ts', [mids[:n], cost_ts, dph, [100] * n, [0] * n, [0] * n,
+                                  dph // 2, np.round(rng.uniform(0, 0.3, n), 2)])
+
+        n = m_day_ts.size
+        _insert(conn, 'avg_ts', [mids[:n], m_day_ts, rng.integers(800, 1000, n), rng.integers(10, 25, n),
+                                 rng.integers(1000, 3000, n), rng.integers(100, 1000, n), rng.integers(100, 1000, n)])
+    conn.commit()
+
+    counts = {tbl_name: conn.execute(f"SELECT count(*) FROM {tbl_name}").fetchone()[0] for tbl_name in SCHEMA}
+    conn.close()
+    logging.info(f"[SYNTHETIC] {db_path}: {n_machines} machines, {days} days, "
+                 f"{sum(counts.values())} rows {time_ms(time() - start)}ms")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate synthetic vast.db')
+    parser.add_argument('db_path', type=str, help='path to created database')
+    parser.add_argument('--machines', type=int, default=200, help='number of machines')
+    parser.add_argument('--days', type=int, default=60, help='length of history in days')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--end_ts', type=int, default=1_710_000_000, help='timestamp of the last row')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    create_db(args.db_path, args.machines, args.days, args.seed, args.end_ts)
@@ -1,28 +1,51 @@
 from __future__ import annotations
 
 import gc
+import importlib
 from collections import deque
 import logging
 import traceback
 import math
 from time import time
+from datetime import datetime, timezone
 import numpy as np
-import pandas as pd
-from pandas.core.dtypes.common import is_integer_dtype, is_float_dtype, is_numeric_dtype, is_string_dtype
 
 
+class LazyModule:
+    """
+    Module imported on its first attribute access. Serving JSON, static
+    files and metrics doesn't need pandas, so processes only pay its import
+    time and memory when a request or background job uses it.
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            # import lock makes concurrent first accesses wait for one import
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+pd = LazyModule('pandas')
 
 
 def time_ms(time_sec: float):
     return int(time_sec * 1000)
 
 
+def debug_enabled() -> bool:
+    """ Guard for debug f-strings on hot paths, they are formatted even when not logged """
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+
 def time_utc_now() -> pd.Timestamp:
-    return pd.Timestamp.utcnow().round(freq='S')
+    return pd.Timestamp.utcnow().round(freq='s')
 
 
 def ts_utc_now() -> int:
-    return int(time_utc_now().timestamp())
+    return round(time())
 
 
 def next_timeout(period=60) -> float:
@@ -108,19 +131,109 @@ def np_group_by(raw: pd.DataFrame, value_col: str, ufunc):
         machine_ids = machine_ids[idx]
         vals = vals[idx]
 
-    # slice_idx = np.r_[0, np.flatnonzero(np.diff(machine_ids)) + 1]
-    slice_idx = np.diff(machine_ids).nonzero()[0] + 1
-    slice_idx = np.hstack([0, slice_idx])    # insert zero at the beginning of arr
+    slice_idx = np_group_slices(machine_ids)
     # return machine_ids[slice_idx], ufunc.reduceat(vals, slice_idx)
     return ufunc.reduceat(vals, slice_idx)
 
 
+def np_group_slices(keys: np.ndarray) -> np.ndarray:
+    """
+    Start indices of the groups of equal consecutive values in sorted array
+    """
+    # slice_idx = np.r_[0, np.flatnonzero(np.diff(keys)) + 1]
+    slice_idx = np.diff(keys).nonzero()[0] + 1
+    return np.hstack([0, slice_idx])    # insert zero at the beginning of arr
+
+
+def np_time_buckets(ts: np.ndarray, n_buckets: int) -> np.ndarray:
+    """
+    Split sorted timestamps into n_buckets equal time intervals
+    :return: bucket number of each timestamp
+    """
+    span = int(ts[-1] - ts[0]) + 1
+    return (ts - ts[0]) * n_buckets // span
+
+
+def np_minmax_downsample(ts: np.ndarray, vals: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Shape preserving downsampling of continuous series. Splits time range
+    into n_out / 2 buckets and keeps points with min and max value of each bucket.
+    :param ts: sorted timestamps
+    :param vals: series values
+    :param n_out: max number of points to keep
+    :return: sorted indices of points to keep
+    """
+    if ts.size <= n_out:
+        return np.arange(ts.size)
+
+    slice_idx = np_group_slices(np_time_buckets(ts, max(n_out // 2 - 1, 1)))
+
+    # np_argmax_reduceat expects non-negative values
+    vals = np.nan_to_num(vals.astype(float))
+    vals = vals - vals.min()
+    idx_max = np_argmax_reduceat(vals, slice_idx)
+    idx_min = np_argmax_reduceat(vals.max() - vals, slice_idx)
+    return np.unique(np.hstack([0, idx_min, idx_max, ts.size - 1]))
+
+
+def np_step_downsample(ts: np.ndarray, changed: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Change point preserving downsampling of step series. Keeps only points
+    where value changes, if there are still more than n_out of them keeps
+    first and last change in each of n_out / 2 time buckets.
+    :param ts: sorted timestamps
+    :param changed: boolean mask of points where value differs from previous one
+    :param n_out: max number of points to keep
+    :return: sorted indices of points to keep
+    """
+    idx = np.union1d(np.flatnonzero(changed), [0, ts.size - 1])
+    if idx.size <= n_out:
+        return idx
+
+    slice_idx = np_group_slices(np_time_buckets(ts[idx], max(n_out // 2 - 1, 1)))
+    last_idx = np.append(slice_idx[1:], idx.size) - 1
+    return np.union1d(idx[slice_idx], idx[last_idx])
+
+
+def np_staircase(ts: np.ndarray, vals: np.ndarray) -> tuple:
+    """
+    Expand step series for line plot: inserts point with previous value
+    one second before every change.
+    :return: expanded timestamps and values
+    """
+    if ts.size < 2:
+        return ts, vals
+    ts_out = np.empty(2 * ts.size - 1, dtype=ts.dtype)
+    ts_out[0::2] = ts
+    ts_out[1::2] = ts[1:] - 1
+    vals_out = np.empty(2 * vals.size - 1, dtype=vals.dtype)
+    vals_out[0::2] = vals
+    vals_out[1::2] = vals[:-1]
+    return ts_out, vals_out
+
+
+def np_ffill_align(ts: np.ndarray, vals: np.ndarray, timeline: np.ndarray) -> np.ndarray:
+    """
+    Value of series at every point of timeline, forward filled from the
+    latest point at or before it. NaN before the first point.
+    :param ts: sorted timestamps of series
+    :param timeline: sorted timestamps to align to
+    """
+    result = np.full(timeline.size, np.nan)
+    if ts.size == 0:
+        return result
+    idx = np.searchsorted(ts, timeline, side='right') - 1
+    known = idx >= 0
+    result[known] = vals[idx[known]]
+    return result
+
+
 def _is_close_to_int(arr) -> bool:
     return np.all(np.isclose(arr, np.round(arr)))
 
 
 def check_if_integer(arr) -> bool:
-    if is_float_dtype(arr):
+    if pd.api.types.is_float_dtype(arr):
         return _is_close_to_int(arr)
     return False
 
@@ -145,12 +258,12 @@ def reduce_mem_usage(df, subset=None, int_cast=True, obj_to_category=False, verb
     for col in cols:
         col_type = df[col].dtype
 
-        if is_numeric_dtype(col_type):
+        if pd.api.types.is_numeric_dtype(col_type):
             c_min = df[col].min()
             c_max = df[col].max()
 
             # test if column can be converted to an integer
-            treat_as_int = is_integer_dtype(col_type)
+            treat_as_int = pd.api.types.is_integer_dtype(col_type)
             if int_cast and not treat_as_int:
                 treat_as_int = check_if_integer(df[col])
 
@@ -178,7 +291,7 @@ def reduce_mem_usage(df, subset=None, int_cast=True, obj_to_category=False, verb
                     df[col] = df[col].astype(np.float32)
                 else:
                     df[col] = df[col].astype(np.float64)
-        elif is_string_dtype(col_type) and obj_to_category:
+        elif pd.api.types.is_string_dtype(col_type) and obj_to_category:
             df[col] = df[col].astype('category')
 
     if verbose:
@@ -250,4 +363,11 @@ class setqueue(object):
 
 
 def datetime_to_ts(date: str):
-    return int(pd.to_datetime(date).timestamp())
+    """ Dates without timezone are UTC. ISO 8601 is parsed by datetime, other formats by pandas """
+    try:
+        dt = datetime.fromisoformat(date)
+    except ValueError:
+        return int(pd.to_datetime(date).timestamp())
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
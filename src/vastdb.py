@@ -1,13 +1,34 @@
-import signal
+from __future__ import annotations
+
+import json
 import sqlite3
-import pandas as pd
-from time import time
+import threading
+import numpy as np
+from time import perf_counter
 import logging
-from src.utils import time_ms, get_error_info
+from src import const
+from src import metrics
+from src.packed import pack_tables
+from src import schema
+from src.rollup import Rollup, rollup_table, ATTACH_NAME
+from src.snapshots import SnapshotStore
+from src.archive import Archive
+from src.utils import LazyModule, time_ms, get_error_info, debug_enabled, is_sorted, np_minmax_downsample, \
+    np_step_downsample, np_group_slices, np_staircase, np_ffill_align
+
+pd = LazyModule('pandas')
 
 
-def _get_sql_query(machine_id, tbl_name, from_ts=None, to_ts=None) -> str:
-    sql_query = f"SELECT * FROM {tbl_name} WHERE machine_id={machine_id}"
+def _get_sql_query(machine_id, tbl_name, from_ts=None, to_ts=None, columns: list = None) -> str:
+    """
+    machine_id can be single id or list of ids
+    :param columns: columns to select, all if not given
+    """
+    select = ', '.join([f'"{col}"' for col in columns]) if columns else '*'
+    if isinstance(machine_id, (list, tuple)):
+        sql_query = f"SELECT {select} FROM {tbl_name} WHERE machine_id IN ({','.join(str(int(i)) for i in machine_id)})"
+    else:
+        sql_query = f"SELECT {select} FROM {tbl_name} WHERE machine_id={machine_id}"
     if from_ts:
         sql_query += f" AND timestamp >= {from_ts}"
     if to_ts:
@@ -15,14 +36,158 @@ def _get_sql_query(machine_id, tbl_name, from_ts=None, to_ts=None) -> str:
     return sql_query
 
 
+def _get_json_sql_query(machine_id, tbl_name, columns: list, from_ts=None, to_ts=None, fmt='records') -> str:
+    """
+    Query returning the whole table request as a single json text value,
+    in the same layout as df_to_json()
+    """
+    sql_query = _get_sql_query(machine_id, tbl_name, from_ts, to_ts, columns)
+    if fmt == 'columns':
+        pairs = ', '.join([f"'{col}', json_group_array(\"{col}\")" for col in columns])
+        return f"SELECT json_object({pairs}) FROM ({sql_query})"
+    return f"SELECT json_group_array({_json_row_sql(columns)}) FROM ({sql_query})"
+
+
+def _json_row_sql(columns: list) -> str:
+    pairs = ', '.join([f"'{col}', \"{col}\"" for col in columns])
+    return f"json_object({pairs})"
+
+
+def df_to_json(df: pd.DataFrame, fmt: str = 'records') -> str:
+    """
+    Serialize dataframe to json string.
+    'records' - list of row objects [{col: val, ...}, ...]
+    'columns' - object of column arrays {col: [val, ...], ...}
+    """
+    if fmt == 'columns':
+        return '{' + ','.join([f'{json.dumps(col)}: {df[col].to_json(orient="values")}' for col in df.columns]) + '}'
+    return df.to_json(orient='records')
+
+
+def frames_to_message(frames: dict, fmt: str = 'records'):
+    """
+    Serialize {tbl_name: dataframe} into one response in format `fmt`
+    :return: json bytes, or list of bytes-like parts for 'binary' format
+    """
+    with metrics.SERIALIZE_SECONDS.time(format=fmt):
+        if fmt == 'binary':
+            return pack_tables(frames)
+        result = {tbl_name: df_to_json(df, fmt) for tbl_name, df in frames.items()}
+    return ('{' + ','.join([f'"{k}": {v}' for (k, v) in result.items()]) + '}').encode('utf-8')
+
+
+def downsample_df(df: pd.DataFrame, tbl_name: str, points: int) -> pd.DataFrame:
+    """
+    Reduce time series table to about `points` rows. Continuous series
+    keep min/max of each time bucket, step series keep their change points.
+    """
+    if len(df) <= points:
+        return df
+
+    if not is_sorted(df.timestamp.values):
+        df = df.sort_values('timestamp', kind='stable')
+
+    ts = df.timestamp.values
+    if tbl_name in const.CONTINUOUS_TS:
+        idx = np_minmax_downsample(ts, df[const.CONTINUOUS_TS[tbl_name]].values, points)
+    else:
+        vals = df.drop(columns=['machine_id', 'timestamp'], errors='ignore')
+        changed = (vals != vals.shift()).any(axis=1).values
+        idx = np_step_downsample(ts, changed, points)
+    return df.iloc[idx]
+
+
+def split_by_machine(df: pd.DataFrame) -> dict:
+    """
+    Split rows of several machines into {machine_id: dataframe}
+    with the same sort and slice approach as np_group_by()
+    """
+    if df.empty:
+        return {}
+
+    machine_ids = df.machine_id.values
+    if not is_sorted(machine_ids):
+        df = df.iloc[np.argsort(machine_ids, kind='stable')]
+        machine_ids = df.machine_id.values
+
+    bounds = np.append(np_group_slices(machine_ids), len(df))
+    return {int(machine_ids[start]): df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])}
+
+
+class ConnectionPool:
+    """
+    Pool of reusable SQLite connections, one per worker thread.
+    Connections are opened lazily on first use in a thread and kept open
+    until close_all(). Read-only pools open the database with URI mode=ro,
+    so readers never take write locks and work alongside a WAL writer.
+    """
+    def __init__(self, db_path: str, read_only: bool = True, attach: dict = None):
+        """
+        :param attach: {name: path} of databases attached to every connection
+        """
+        self.db_path = db_path
+        self.read_only = read_only
+        self.attach = attach or {}
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for name, path in self.attach.items():
+            path = f"file:{path}?mode=ro" if self.read_only else path
+            conn.execute(f"ATTACH DATABASE ? AS {name}", (path,))
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+            logging.debug(f"[DB] Opened connection #{len(self._conns)} in {threading.current_thread().name}")
+        return conn
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+        self._local = threading.local()
+
+
 class VastDB:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, read_only: bool = True, rollup: Rollup = None,
+                 snapshots: SnapshotStore = None, archive: Archive = None):
+        """
+        :param rollup: hourly/daily rollups used for long time ranges
+        :param snapshots: in-memory snapshot tables, read instead of database when loaded
+        :param archive: columnar archive, read instead of database for sealed part of raw time series
+        """
         self.db_path = db_path
-        self.conn = None
+        self.rollup = rollup
+        self.snapshots = snapshots
+        self.archive = archive
+        attach = {ATTACH_NAME: rollup.rollup_path} if rollup else None
+        self.pool = ConnectionPool(db_path, read_only=read_only, attach=attach)
+        self._version_conn = None
+        self._version_lock = threading.Lock()
+        self._columns = {}
+        self._registry = None
+        self._last_ts = {}
+        self._last_ts_version = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.pool.get()
 
     def __enter__(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            self.pool.get()
             return self
         except Exception as e:
             msg = f"[DB] Connection error: {get_error_info(e)}"
@@ -30,15 +195,149 @@ class VastDB:
             raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+        # connection stays open in the pool for the next request of this thread
         if exc_type:
             msg = f"[DB] {exc_type} during Database Operations:{exc_val}\n{exc_tb}"
             logging.error(msg)
-            raise
+        return False
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        self.pool.close_all()
+        with self._version_lock:
+            if self._version_conn:
+                self._version_conn.close()
+                self._version_conn = None
+
+    def data_version(self):
+        """
+        PRAGMA data_version of a dedicated connection. The value is only
+        meaningful within this connection and changes whenever another
+        connection (i.e. the collector) commits to the database.
+        With rollups it is paired with rollup generation.
+        """
+        with self._version_lock:
+            if self._version_conn is None:
+                self._version_conn = self.pool.connect()
+            version = self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+        if self.rollup:
+            return version, self.rollup.generation
+        return version
+
+    def snapshot_timestamps(self, machine_id: int) -> dict:
+        """ {tbl_name: latest timestamp of the machine} of tables served from snapshot store """
+        if self.snapshots is None or not self.snapshots.ready:
+            return {}
+        return self.snapshots.last_timestamps(machine_id)
+
+    def last_timestamps(self, machine_id: int, version) -> tuple:
+        """
+        Latest timestamp of every table of the machine, one index lookup per
+        table. Tables served from snapshot store take it from the store, so
+        it changes when the served rows do, not when the database does.
+        Tables without timestamp column are represented by data version
+        itself. Memoized until data version or snapshot store changes.
+        """
+        memo_version = (version, self.snapshots and self.snapshots.version)
+        with self._version_lock:
+            if memo_version != self._last_ts_version:
+                self._last_ts = {}
+                self._last_ts_version = memo_version
+            result = self._last_ts.get(machine_id)
+        if result is not None:
+            return result
+
+        row = self.snapshot_timestamps(machine_id)
+        tables = [tbl_name for tbl_name in const.TS_TABLES + const.SNP_TABLES
+                  if tbl_name not in row and 'timestamp' in self.table_columns(tbl_name)]
+        if tables:
+            sql_query = 'SELECT ' + ', '.join([f'(SELECT max(timestamp) FROM {tbl_name} '
+                                               f'WHERE machine_id={int(machine_id)})' for tbl_name in tables])
+            row.update(zip(tables, self.execute(sql_query).fetchone()))
+        result = tuple(row.get(tbl_name, version) for tbl_name in const.TS_TABLES + const.SNP_TABLES)
+        with self._version_lock:
+            if memo_version == self._last_ts_version:
+                self._last_ts[machine_id] = result
+        return result
+
+    def source_table(self, tbl_name: str, from_ts=None, to_ts=None, resolution='auto') -> str:
+        """ Table to read time series from: raw table or its rollup tier """
+        if self.rollup is None or tbl_name not in const.TS_TABLES:
+            return tbl_name
+        tier = self.rollup.select_tier(tbl_name, from_ts, to_ts, resolution)
+        if tier is None:
+            return tbl_name
+        return f"{ATTACH_NAME}.{rollup_table(tbl_name, tier)}"
+
+    def rollup_until(self, from_ts=None, to_ts=None, resolution='auto') -> int | None:
+        """
+        Timestamp up to which rollup tiers serving the request are complete,
+        None when every table is served raw or the range ends before it.
+        """
+        if self.rollup is None:
+            return None
+        marks = [self.rollup.high_water_mark(tbl_name) for tbl_name in const.TS_TABLES
+                 if self.rollup.select_tier(tbl_name, from_ts, to_ts, resolution)]
+        until = min([mark for mark in marks if mark is not None], default=None)
+        if until is None or (to_ts is not None and to_ts <= until):
+            return None
+        return until
+
+    def table_columns(self, tbl_name: str) -> list:
+        columns = self._columns.get(tbl_name)
+        if columns is None:
+            columns = schema.table_columns(self.conn, tbl_name)
+            self._columns[tbl_name] = columns
+        return columns
+
+    @property
+    def registry(self) -> schema.Registry:
+        """ Columns of served tables and field profiles (const.FIELD_PROFILES) """
+        if self._registry is None:
+            self._registry = schema.Registry(self.conn, const.TS_TABLES + const.SNP_TABLES, const.FIELD_PROFILES)
+        return self._registry
+
+    def select_columns(self, tbl_name: str, fields: dict = None, source: str = None) -> list | None:
+        """
+        Columns to read from source table (raw or rollup) for requested fields,
+        rollup tables add min/max of every column. None means all columns.
+        """
+        if not fields or tbl_name not in fields:
+            return None
+        source_columns = self.table_columns(source or tbl_name)
+        return [col for field in fields[tbl_name] for col in (field, f'{field}_min', f'{field}_max')
+                if col in source_columns]
+
+    def check_schema(self, create_indexes=True, strict=False) -> list:
+        """
+        Startup check of tables used by get_machine_stats(). Creates missing
+        (machine_id, timestamp) indexes and verifies with EXPLAIN QUERY PLAN
+        that none of the /stats query shapes does full table scan.
+        :param create_indexes: create missing indexes, needs write access to db
+        :param strict: raise RuntimeError if any query scans
+        :return: list of scanning query plans
+        """
+        tables = const.TS_TABLES + const.SNP_TABLES
+        if create_indexes:
+            schema.ensure_indexes(self.db_path, tables, const.FIELD_PROFILES[const.DEFAULT_FIELDS])
+
+        queries = []
+        for tbl_name in const.TS_TABLES:
+            queries.append(_get_sql_query(0, tbl_name))
+            queries.append(_get_sql_query(0, tbl_name, 1, 2))
+        for tbl_name in const.SNP_TABLES:
+            queries.append(_get_sql_query(0, tbl_name))
+
+        scans = []
+        for sql_query in queries:
+            for detail in schema.query_scans(self.conn, sql_query, tables):
+                logging.error(f"[SCHEMA] Full scan: {detail} in query: {sql_query}")
+                scans.append(detail)
+
+        if scans and strict:
+            raise RuntimeError(f"{len(scans)} /stats queries do full table scan")
+        if not scans:
+            logging.info("[SCHEMA] All /stats queries use indexes")
+        return scans
 
     def execute(self, sql_query):
         try:
@@ -47,33 +346,346 @@ class VastDB:
             logging.error(f"Error executing sql command: {sql_query}\n{e}")
             raise
 
-    def request_to_json(self, machine_id, tbl_name, from_ts=None, to_ts=None):
-        sql_query = _get_sql_query(machine_id, tbl_name, from_ts, to_ts)
+    def request_to_df(self, machine_id, tbl_name, from_ts=None, to_ts=None, points=None,
+                      source=None, columns: list = None) -> pd.DataFrame:
+        """
+        :param source: table to read instead of tbl_name, i.e. its rollup
+        :param columns: columns to read, all if not given
+        """
+        source = source or tbl_name
+        start = perf_counter()
+        if self.archived(tbl_name, source, from_ts):
+            df = self._archive_df(machine_id, tbl_name, from_ts, to_ts, columns)
+        else:
+            df = pd.read_sql(_get_sql_query(machine_id, source, from_ts, to_ts, columns), con=self.conn)
+        elapsed = perf_counter() - start
+        metrics.QUERY_SECONDS.observe(elapsed, table=tbl_name)
+        if debug_enabled():
+            logging.debug(f'[{source.upper()}] read {len(df)} records {time_ms(elapsed)}ms')
+
+        if points:
+            df = downsample_df(df, tbl_name, points)
+        return df
+
+    def archived(self, tbl_name: str, source: str, from_ts=None) -> bool:
+        """ Raw rows of the range start in the archive """
+        return self.archive is not None and source == tbl_name and self.archive.covers(tbl_name, from_ts)
 
-        start = time()
-        df = pd.read_sql(sql_query, con=self.conn)
-        logging.debug(f'[{tbl_name.upper()}] read sql {len(df)} records {time_ms(time() - start)}ms')
+    def _archive_df(self, machine_id, tbl_name: str, from_ts=None, to_ts=None, columns: list = None) -> pd.DataFrame:
+        """ Sealed part of the range from archive, followed by the recent rows from database """
+        sealed = self.archive.sealed_until(tbl_name)
+        cold_to = sealed - 1 if to_ts is None else min(to_ts, sealed - 1)
+        cold = self.archive.read(tbl_name, machine_id, from_ts, cold_to, columns)
+        if to_ts is not None and to_ts < sealed:
+            return cold
+        hot = pd.read_sql(_get_sql_query(machine_id, tbl_name, sealed, to_ts, columns), con=self.conn)
+        # concat of an empty frame would turn its columns into objects
+        if hot.empty:
+            return cold
+        if cold.empty:
+            return hot
+        return pd.concat([cold, hot], ignore_index=True)
 
-        # start = time()
-        json_data = df.to_json(orient='records')
-        # logging.debug(f'[{tbl_name.upper()}] convert to json {time_ms(time() - start)}ms')
+    def request_to_json(self, machine_id, tbl_name, from_ts=None, to_ts=None, fmt='records', points=None,
+                        source=None, columns: list = None):
+        df = self.request_to_df(machine_id, tbl_name, from_ts, to_ts, points, source, columns)
+
+        with metrics.SERIALIZE_SECONDS.time(format=fmt):
+            json_data = df_to_json(df, fmt)
         return json_data
 
+    def snapshot_df(self, machine_id, tbl_name: str, columns: list = None) -> pd.DataFrame:
+        """ Rows of snapshot table from SnapshotStore if it holds the table, otherwise from database """
+        if self.snapshots is not None and tbl_name in self.snapshots:
+            return pd.DataFrame(self.snapshots.get(tbl_name, machine_id, columns))
+        return self.request_to_df(machine_id, tbl_name, columns=columns)
+
     def table_to_df(self, tbl_name: str):
+        if self.snapshots is not None and tbl_name in self.snapshots:
+            return pd.DataFrame(self.snapshots.table(tbl_name))
         df = pd.read_sql_query(f"SELECT * FROM {tbl_name}", con=self.conn)
         return df
 
-    def get_machine_stats(self, machine_id: int, from_ts=None, to_ts=None):
+    def get_machine_frames(self, machine_id: int, from_ts=None, to_ts=None, points=None, resolution='auto',
+                           fields: dict = None) -> dict:
         result = {}
-        ts_cols = ['rent_ts', 'reliability_ts', 'cost_ts', 'hardware_ts', 'avg_ts']
-        snp_cols = ['eod_snp', 'disk_snp', 'cpu_ram_snp']
+        for tbl_name in const.TS_TABLES:
+            source = self.source_table(tbl_name, from_ts, to_ts, resolution)
+            result[tbl_name] = self.request_to_df(machine_id, tbl_name, from_ts, to_ts, points, source,
+                                                  self.select_columns(tbl_name, fields, source))
+        for tbl_name in const.SNP_TABLES:
+            result[tbl_name] = self.snapshot_df(machine_id, tbl_name, self.select_columns(tbl_name, fields))
+        return result
+
+    def get_machine_stats(self, machine_id: int, from_ts=None, to_ts=None, fmt='records', points=None,
+                          resolution='auto', fields: dict = None):
+        """
+        All tables of the machine serialized in format `fmt`.
+        Json without downsampling is assembled by SQLite in a single query,
+        otherwise tables go through pandas.
+        :param resolution: 'raw', rollup tier or 'auto' to pick one by time range
+        :param fields: {tbl_name: [columns]} to serve, other tables are served whole (see Registry.resolve())
+        :return: json bytes, or list of bytes-like parts for 'binary' format (see packed.py)
+        """
+        if fmt == 'binary':
+            frames = self.get_machine_frames(machine_id, from_ts, to_ts, points, resolution, fields)
+            with metrics.SERIALIZE_SECONDS.time(format=fmt):
+                return pack_tables(frames)
+        if points:
+            return self.get_machine_stats_pandas(machine_id, from_ts, to_ts, fmt, points, resolution, fields)
+        return self.get_machine_stats_sql(machine_id, from_ts, to_ts, fmt, resolution, fields)
+
+    def get_machine_delta(self, machine_id: int, since: dict, from_ts=None, to_ts=None, fmt='records', version=None,
+                          fields: dict = None):
+        """
+        Rows newer than client's latest timestamp of every table.
+        Time series tables are always present, possibly empty, and are only
+        queried when they have newer rows. Snapshot tables are included only
+        when they changed.
+        :param since: {tbl_name: timestamp} of the latest row client has
+        :return: json bytes, or list of bytes-like parts for 'binary' format
+        """
+        return frames_to_message(self.delta_frames(machine_id, since, from_ts, to_ts, version, fields=fields), fmt)
+
+    def delta_frames(self, machine_id: int, since: dict, from_ts=None, to_ts=None, version=None,
+                     tables: list = None, fields: dict = None) -> dict:
+        """ Dataframes of get_machine_delta() """
+        all_tables = const.TS_TABLES + const.SNP_TABLES
+        last_ts = dict(zip(all_tables, self.last_timestamps(machine_id, version)))
+        frames = {}
+        for tbl_name in tables or all_tables:
+            has_ts = 'timestamp' in self.table_columns(tbl_name)
+            changed = not has_ts or (last_ts[tbl_name] is not None and last_ts[tbl_name] > since[tbl_name])
+            columns = self.select_columns(tbl_name, fields)
+            if tbl_name in const.SNP_TABLES:
+                if changed:
+                    frames[tbl_name] = self.snapshot_df(machine_id, tbl_name, columns)
+            elif changed:
+                frames[tbl_name] = self.request_to_df(machine_id, tbl_name, max(from_ts or 0, since[tbl_name] + 1), to_ts,
+                                                      columns=columns)
+            else:
+                frames[tbl_name] = pd.DataFrame(columns=columns or self.table_columns(tbl_name))
+        return frames
+
+    def _seeded_df(self, machine_id: int, tbl_name: str, from_ts=None, to_ts=None, points=None,
+                   resolution='auto', columns: list = None) -> pd.DataFrame:
+        """ Rows of the range preceded by the latest row before it, which sets value at the range start """
+        source = self.source_table(tbl_name, from_ts, to_ts, resolution)
+        if columns:
+            columns = self.select_columns(tbl_name, {tbl_name: columns}, source)
+        df = self.request_to_df(machine_id, tbl_name, from_ts, to_ts, points, source, columns)
+        if not from_ts:
+            return df
+        seed = pd.read_sql(f"{_get_sql_query(machine_id, source, columns=columns)} AND timestamp < {from_ts} "
+                           f"ORDER BY timestamp DESC LIMIT 1", con=self.conn)
+        if seed.empty:
+            return df
+        return pd.concat([seed, df], ignore_index=True) if len(df) else seed
 
-        for tbl_name in ts_cols:
-            result[tbl_name] = self.request_to_json(machine_id, tbl_name, from_ts, to_ts)
-        for tbl_name in snp_cols:
-            result[tbl_name] = self.request_to_json(machine_id, tbl_name)
+    def get_machine_aligned(self, machine_id: int, from_ts=None, to_ts=None, fmt='records', points=None,
+                            resolution='auto', since: dict = None, version=None, fields: dict = None):
+        """
+        Plot-ready series on one shared timeline (const.ALIGNED_SERIES):
+        step series are expanded into staircases, all series are forward
+        filled onto the union of their timestamps and cost is divided by
+        number of GPUs. Returned as 'aligned' table next to hardware_ts,
+        avg_ts and snapshot tables.
+        With `since` only timeline points after it are returned, series are
+        seeded with their latest row before it so values continue correctly.
+        """
+        lower = from_ts
+        if since:
+            lower = max(from_ts or 0, min(since[tbl_name] for tbl_name, _, _ in const.ALIGNED_SERIES.values()) + 1)
+
+        series = {}
+        tables = [(name, tbl_name, col, div) for name, (tbl_name, col, div) in const.ALIGNED_SERIES.items()]
+        tables.append(('num_gpus', 'hardware_ts', 'num_gpus', 1))
+        hw_columns = self.select_columns('hardware_ts', fields)
+        hardware = None
+        for name, tbl_name, col, div in tables:
+            if tbl_name == 'hardware_ts':
+                # read once, for the series and as hardware_ts table of the response
+                columns = hw_columns and [c for c in self.table_columns(tbl_name)
+                                          if c in hw_columns or c == col]
+                df = self._seeded_df(machine_id, tbl_name, lower, to_ts, points, resolution, columns)
+                hardware = df if hw_columns is None else df[hw_columns]
+            else:
+                df = self._seeded_df(machine_id, tbl_name, lower, to_ts, points, resolution, ['timestamp', col])
+            ts = df.timestamp.values.astype(np.int64)
+            vals = df[col].values.astype(float) / div
+            if tbl_name not in const.CONTINUOUS_TS:
+                ts, vals = np_staircase(ts, vals)
+            series[name] = (ts, vals)
+
+        timeline = np.unique(np.concatenate([ts for ts, _ in series.values()]))
+        if lower:
+            timeline = timeline[timeline >= lower]
+        aligned = {'timestamp': timeline}
+        for name, (ts, vals) in series.items():
+            aligned[name] = np_ffill_align(ts, vals, timeline)
+        num_gpus = aligned.pop('num_gpus')
+        num_gpus[num_gpus == 0] = np.nan
+        aligned['cost'] = aligned['cost'] / num_gpus
+
+        frames = {'aligned': pd.DataFrame(aligned)}
+        if since:
+            frames.update(self.delta_frames(machine_id, since, from_ts, to_ts, version,
+                                            ['hardware_ts', 'avg_ts'] + const.SNP_TABLES, fields))
+        else:
+            frames['hardware_ts'] = hardware
+            frames['avg_ts'] = self.request_to_df(machine_id, 'avg_ts', from_ts, to_ts,
+                                                  columns=self.select_columns('avg_ts', fields))
+            for tbl_name in const.SNP_TABLES:
+                frames[tbl_name] = self.snapshot_df(machine_id, tbl_name, self.select_columns(tbl_name, fields))
+        return frames_to_message(frames, fmt)
+
+    def get_machine_stats_pandas(self, machine_id: int, from_ts=None, to_ts=None, fmt='records', points=None,
+                                 resolution='auto', fields: dict = None):
+        result = {}
+        for tbl_name in const.TS_TABLES:
+            source = self.source_table(tbl_name, from_ts, to_ts, resolution)
+            result[tbl_name] = self.request_to_json(machine_id, tbl_name, from_ts, to_ts, fmt, points, source,
+                                                    self.select_columns(tbl_name, fields, source))
+        for tbl_name in const.SNP_TABLES:
+            df = self.snapshot_df(machine_id, tbl_name, self.select_columns(tbl_name, fields))
+            with metrics.SERIALIZE_SECONDS.time(format=fmt):
+                result[tbl_name] = df_to_json(df, fmt)
 
         json_data = ('{' + ','.join([f'"{k}": {v}' for (k, v) in result.items()]) + '}').encode('utf-8')
 
         return json_data
 
+    def get_machine_stats_sql(self, machine_id: int, from_ts=None, to_ts=None, fmt='records', resolution='auto',
+                              fields: dict = None):
+        """
+        Builds json of every table inside SQLite with json_group_array() in one
+        statement, returning one text column per table. Snapshot tables held by
+        SnapshotStore are serialized from memory instead.
+        """
+        tables = list(const.TS_TABLES)
+        subqueries = []
+        for tbl_name in const.TS_TABLES:
+            source = self.source_table(tbl_name, from_ts, to_ts, resolution)
+            columns = self.select_columns(tbl_name, fields, source) or self.table_columns(source)
+            subqueries.append(_get_json_sql_query(machine_id, source, columns, from_ts, to_ts, fmt))
+        stored = {}
+        for tbl_name in const.SNP_TABLES:
+            columns = self.select_columns(tbl_name, fields)
+            if self.snapshots is not None and tbl_name in self.snapshots:
+                with metrics.SERIALIZE_SECONDS.time(format=fmt):
+                    stored[tbl_name] = self.snapshots.to_json(tbl_name, machine_id, columns, fmt)
+            else:
+                tables.append(tbl_name)
+                subqueries.append(_get_json_sql_query(machine_id, tbl_name, columns or self.table_columns(tbl_name),
+                                                      fmt=fmt))
+        sql_query = 'SELECT ' + ', '.join([f'({q})' for q in subqueries])
+
+        start = perf_counter()
+        row = self.execute(sql_query).fetchone()
+        elapsed = perf_counter() - start
+        # json is built by the query itself, so it is timed as a whole
+        metrics.QUERY_SECONDS.observe(elapsed, table='all')
+        if debug_enabled():
+            logging.debug(f'[SQL JSON] {len(tables)} tables {time_ms(elapsed)}ms')
+
+        result = dict(zip(tables, row))
+        result.update(stored)
+        json_data = ('{' + ','.join([f'"{k}": {result[k]}' for k in const.TS_TABLES + const.SNP_TABLES]) + '}')
+
+        return json_data.encode('utf-8')
+
+    def get_host_machines(self, host_id: int) -> list:
+        if self.snapshots is not None and 'machine_host_map' in self.snapshots:
+            return self.snapshots.host_machines(host_id)
+        rows = self.execute(f"SELECT DISTINCT machine_id FROM machine_host_map WHERE host_id={int(host_id)}")
+        return sorted(row[0] for row in rows)
+
+    def find_machines(self, prefix: str, limit: int) -> list:
+        """ Machine ids starting with prefix, in string order """
+        if self.snapshots is not None and 'machine_host_map' in self.snapshots:
+            return self.snapshots.find_machines(prefix, limit)
+        rows = self.execute(f"SELECT DISTINCT machine_id FROM machine_host_map "
+                            f"WHERE CAST(machine_id AS TEXT) LIKE '{prefix}%' "
+                            f"ORDER BY CAST(machine_id AS TEXT) LIMIT {int(limit)}")
+        return [row[0] for row in rows]
+
+    def get_machines_stats(self, machine_ids: list, from_ts=None, to_ts=None, fmt='records', points=None,
+                           resolution='auto', fields: dict = None):
+        """
+        Stats of several machines with one IN (...) query per table,
+        rows are split by machine afterwards.
+        :return: json bytes {machine_id: {tbl_name: table, ...}, ...}
+        """
+        result = {machine_id: {} for machine_id in machine_ids}
+        for tbl_name in const.TS_TABLES + const.SNP_TABLES:
+            is_ts = tbl_name in const.TS_TABLES
+            source = self.source_table(tbl_name, from_ts, to_ts, resolution) if is_ts else tbl_name
+            columns = self.select_columns(tbl_name, fields, source)
+            # rows are split by machine_id, so it is read even when not requested
+            read_columns = columns and (columns if 'machine_id' in columns else ['machine_id'] + columns)
+            if is_ts:
+                df = self.request_to_df(machine_ids, tbl_name, from_ts, to_ts, source=source, columns=read_columns)
+            else:
+                df = self.snapshot_df(machine_ids, tbl_name, read_columns)
+
+            groups = split_by_machine(df)
+            for machine_id in machine_ids:
+                machine_df = groups.get(machine_id, df.iloc[:0])
+                if read_columns != columns:
+                    machine_df = machine_df[columns]
+                if points and is_ts:
+                    machine_df = downsample_df(machine_df, tbl_name, points)
+                with metrics.SERIALIZE_SECONDS.time(format=fmt):
+                    result[machine_id][tbl_name] = df_to_json(machine_df, fmt)
+
+        json_data = '{' + ','.join(['"%d": {' % machine_id + ','.join([f'"{k}": {v}' for (k, v) in tables.items()]) + '}'
+                                    for machine_id, tables in result.items()]) + '}'
+        return json_data.encode('utf-8')
+
+    def iter_machine_stats(self, machine_id: int, from_ts=None, to_ts=None, fmt='records', points=None,
+                           resolution='auto', fields: dict = None):
+        """
+        Same json as get_machine_stats() generated piece by piece, every table
+        is yielded as soon as its query finishes. Records of tables without
+        downsampling are streamed from cursor in batches of const.STREAM_BATCH
+        rows, so the whole response is never held in memory.
+        """
+        sep = '{'
+        for tbl_name in const.TS_TABLES + const.SNP_TABLES:
+            yield f'{sep}"{tbl_name}": '
+            sep = ','
+
+            is_ts = tbl_name in const.TS_TABLES
+            tbl_from, tbl_to = (from_ts, to_ts) if is_ts else (None, None)
+            source = self.source_table(tbl_name, from_ts, to_ts, resolution)
+            columns = self.select_columns(tbl_name, fields, source)
+            if points and is_ts:
+                yield self.request_to_json(machine_id, tbl_name, tbl_from, tbl_to, fmt, points, source, columns)
+            elif not is_ts and self.snapshots is not None and tbl_name in self.snapshots:
+                yield self.snapshots.to_json(tbl_name, machine_id, columns, fmt)
+            elif fmt == 'columns':
+                sql_query = _get_json_sql_query(machine_id, source, columns or self.table_columns(source),
+                                                 tbl_from, tbl_to, fmt)
+                with metrics.QUERY_SECONDS.time(table=tbl_name):
+                    json_data = self.execute(sql_query).fetchone()[0]
+                yield json_data
+            else:
+                sql_query = _get_sql_query(machine_id, source, tbl_from, tbl_to, columns)
+                sql_query = f"SELECT {_json_row_sql(columns or self.table_columns(source))} FROM ({sql_query})"
+                yield from self._iter_json_rows(sql_query, tbl_name)
+        yield '}'
+
+    def _iter_json_rows(self, sql_query, tbl_name):
+        """ Json array of single column json rows, yielded in batches """
+        # query time excludes time spent by consumer between batches
+        start = perf_counter()
+        cursor = self.execute(sql_query)
+        elapsed = 0
+        sep = '['
+        while rows := cursor.fetchmany(const.STREAM_BATCH):
+            elapsed += perf_counter() - start
+            yield sep + ','.join([row[0] for row in rows])
+            sep = ','
+            start = perf_counter()
+        metrics.QUERY_SECONDS.observe(elapsed + perf_counter() - start, table=tbl_name)
+        yield ']' if sep == ',' else '[]'
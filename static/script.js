@@ -80,6 +80,42 @@ function updateInfo(data) {
     }
 }
 
+const REFRESH_INTERVAL = 60 * 1000;
+const TS_TABLES = ['rent_ts', 'reliability_ts', 'cost_ts', 'hardware_ts', 'avg_ts'];
+const APPEND_TABLES = [...TS_TABLES, 'aligned'];
+
+// request and packed tables of the plotted machine, live refresh appends to them
+let current = null;
+let refreshTimer = null;
+
+// Fetch tables from server, packed binary if supported
+function fetchPacked(url) {
+    return fetch(url, {headers: {'Accept': `${BINARY_MIME}, application/json`}})
+        .then(response => {
+            if (!response.ok)
+                throw new Error(`${response.status} ${response.statusText}`);
+            if (response.headers.get('Content-Type') === BINARY_MIME)
+                return response.arrayBuffer().then(buffer => unpackBinary(buffer));
+            return response.json();
+        });
+}
+
+function renderPacked(packed) {
+    let data = unpackJSON(packed);
+    if (!packed.aligned) {
+        data.timeseries = fillMissingValues(data.timeseries);
+        data.timeseries = costPerGPU(data.timeseries);
+    }
+
+    updateInfo(data);
+
+    if (plots) {
+        updatePlots(data);
+    } else {
+        createPlots(data);
+    }
+}
+
 // Function to fetch data and update plot
 function handleSubmitForm() {
     // Get form values
@@ -93,28 +129,12 @@ function handleSubmitForm() {
     // Show loading spinner and disable button
     showLoading();
 
-    // Fetch data from server
-    fetch(url)
-        .then(response => response.json())
-        .then(packed => unpackJSON(packed))
-        .then(data => {
-            data.timeseries = fillMissingValues(data.timeseries);
-            data.timeseries = costPerGPU(data.timeseries);
-            return data;
-        })
-        .then(data => {
-            // console.log(data);
-            // console.log(data[0]);
+    fetchPacked(url)
+        .then(packed => {
             // Hide loading spinner and enable button
             hideLoading();
-
-            updateInfo(data);
-
-            if (plots) {
-                updatePlots(data);
-            } else {
-                createPlots(data);
-            }
+            current = {url: url, packed: packed};
+            renderPacked(packed);
         })
         .catch(error => {
             // Hide loading spinner and enable button
@@ -123,6 +143,60 @@ function handleSubmitForm() {
         });
 }
 
+// Latest timestamp of every table client has, as since_<table> params
+function getSinceParams(packed) {
+    let params = '';
+    for (const [tblName, table] of Object.entries(packed)) {
+        const ts = table.timestamp;
+        if (!ts || !ts.length)
+            continue;
+        // aligned series continue from the end of shared timeline
+        const name = tblName === 'aligned' ? 'since' : `since_${tblName}`;
+        params += `&${name}=${ts.reduce((a, b) => Math.max(a, b))}`;
+    }
+    return params;
+}
+
+// Append delta tables to packed ones, snapshot tables are only sent when changed and replace old ones
+function appendPacked(packed, delta) {
+    for (const [tblName, table] of Object.entries(delta)) {
+        if (!APPEND_TABLES.includes(tblName) || !packed[tblName]) {
+            packed[tblName] = table;
+            continue;
+        }
+        const length = table.timestamp?.length ?? 0;
+        if (!length)
+            continue;
+        for (const col of Object.keys(packed[tblName]))
+            packed[tblName][col] = Array.from(packed[tblName][col]).concat(Array.from(table[col] ?? []));
+    }
+    return packed;
+}
+
+// Poll rows newer than the plotted ones and append them to the plots
+function refreshPlots() {
+    if (!current)
+        return;
+    const request = current;
+    fetchPacked(request.url + getSinceParams(request.packed))
+        .then(delta => {
+            // machine changed while waiting for the response
+            if (request !== current)
+                return;
+            renderPacked(appendPacked(request.packed, delta));
+        })
+        .catch(error => console.error('Error refreshing data:', error));
+}
+
+function setAutoRefresh(enabled) {
+    clearInterval(refreshTimer);
+    refreshTimer = enabled ? setInterval(refreshPlots, REFRESH_INTERVAL) : null;
+}
+
+document.getElementById("live-refresh").addEventListener("change", function(event) {
+    setAutoRefresh(event.target.checked);
+});
+
 // Event listener to update plot when the form is submitted
 plotForm.addEventListener("submit", function(event) {
     event.preventDefault();
@@ -443,6 +517,44 @@ function staircaseFill(data) {
     return [ts_filled, vals_filled];
 }
 
+// Get single row of a columnar table as an object, negative index counts from the end
+function getRow(table, index) {
+    let row = {};
+    for (const key of Object.keys(table))
+        row[key] = table[key].at(index);
+    return row;
+}
+
+const BINARY_MIME = 'application/vnd.vast-stats.columns';
+const TYPED_ARRAYS = {
+    'f8': Float64Array,
+    'f4': Float32Array,
+    'i4': Int32Array,
+};
+
+// Decode packed binary response into columnar tables, format is described in src/packed.py
+function unpackBinary(buffer) {
+    console.time('unpack binary');
+    const view = new DataView(buffer);
+    const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4));
+    if (magic !== 'VST1')
+        throw new Error(`unknown binary format: ${magic}`);
+
+    const headerLen = view.getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLen)));
+    const dataStart = 8 + headerLen;
+
+    let packed = {};
+    for (const [tblName, tbl] of Object.entries(header.tables)) {
+        let table = {...tbl.values};
+        for (const [col, meta] of Object.entries(tbl.columns))
+            table[col] = new TYPED_ARRAYS[meta.dtype](buffer, dataStart + meta.offset, tbl.length);
+        packed[tblName] = table;
+    }
+    console.timeEnd('unpack binary');
+    return packed;
+}
+
 function unpackJSON(packed) {
 
     // console.log('unpackJSON', packed, packed.reliability_ts);
@@ -450,38 +562,46 @@ function unpackJSON(packed) {
     let ts = {};
     let info = {};
 
-    ts['reliability'] = [
-        packed.reliability_ts.map(entry => entry.timestamp),
-        packed.reliability_ts.map(entry => entry.reliability / 100),
-    ]
-
-    ts['rent'] = [
-        packed.rent_ts.map(entry => entry.timestamp),
-        packed.rent_ts.map(entry => entry.num_gpus_rented),
-    ]
-
-    ts['cost'] = [
-        packed.cost_ts.map(entry => entry.timestamp),
-        packed.cost_ts.map(entry => entry.dph_base / 1000),
-    ]
-
-    ts['num_gpus'] = [
-        packed.hardware_ts.map(entry => entry.timestamp),
-        packed.hardware_ts.map(entry => entry.num_gpus),
-    ]
-
-    ts.rent = staircaseFill(ts.rent);
-    ts.cost = staircaseFill(ts.cost);
-    ts.num_gpus = staircaseFill(ts.num_gpus);
+    if (packed.aligned) {
+        // series are plot-ready on a shared timeline (/stats?align=1), NaN of binary format marks gaps
+        const timeline = Array.from(packed.aligned.timestamp);
+        for (const name of ['reliability', 'rent', 'cost'])
+            ts[name] = [timeline, Array.from(packed.aligned[name], val => Number.isNaN(val) ? null : val)];
+    } else {
+        // packed tables are columnar: {column: [values...]}
+        ts['reliability'] = [
+            packed.reliability_ts.timestamp,
+            packed.reliability_ts.reliability.map(val => val / 100),
+        ]
+
+        ts['rent'] = [
+            packed.rent_ts.timestamp,
+            packed.rent_ts.num_gpus_rented,
+        ]
+
+        ts['cost'] = [
+            packed.cost_ts.timestamp,
+            packed.cost_ts.dph_base.map(val => val / 1000),
+        ]
+
+        ts['num_gpus'] = [
+            packed.hardware_ts.timestamp,
+            packed.hardware_ts.num_gpus,
+        ]
+
+        ts.rent = staircaseFill(ts.rent);
+        ts.cost = staircaseFill(ts.cost);
+        ts.num_gpus = staircaseFill(ts.num_gpus);
+    }
 
     console.log('packed_json:   ', packed);
 
-    let hw = packed.hardware_ts.at(-1);
-    let avg = packed.avg_ts.at(-1); // can be zero when machine is less than day online
-    let eod = packed.eod_snp[0];
+    let hw = getRow(packed.hardware_ts, -1);
+    let avg = getRow(packed.avg_ts, -1); // can be empty when machine is less than day online
+    let eod = getRow(packed.eod_snp, 0);
     let num_gpus = hw.num_gpus;
-    const cpu_ram = packed.cpu_ram_snp[0].cpu_ram;
-    const disk_space = packed.disk_snp[0].disk_space;
+    const cpu_ram = packed.cpu_ram_snp.cpu_ram[0];
+    const disk_space = packed.disk_snp.disk_space[0];
 
     let verified_map = {
         0: 'unverified',
@@ -547,8 +667,8 @@ function fillMissingValues(timeseries) {
         values.push(timeseries[keys[i]][1]);
     }
 
-    // Finding unique timestamps from all series
-    let allTimestamps = [...new Set(timestamps.flat())].sort();
+    // Finding unique timestamps from all series, series can be typed arrays
+    let allTimestamps = [...new Set(timestamps.flatMap(ts => Array.from(ts)))].sort((a, b) => a - b);
 
     // Fill missing values with last existing value
     for (let i = 0; i < allTimestamps.length; i++) {
@@ -600,10 +720,12 @@ function hideLoading() {
 
 function getUrl(machineId, fromDate, toDate) {
     // Construct URL
-    let url = `/stats`;
+    // no more points than pixels in plot width
+    const points = Math.round(window.innerWidth * 0.5 * window.devicePixelRatio);
+    let url = `/stats?format=columns&align=1&points=${points}`;
 
     if (machineId) {
-        url += `?machine_id=${machineId}`;
+        url += `&machine_id=${machineId}`;
     }
     if (fromDate) {
         url += `&from=${fromDate}`;